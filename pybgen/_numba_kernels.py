@@ -0,0 +1,101 @@
+"""Numba kernels to decode BGEN files (used when numba is installed)."""
+
+# This file is part of pybgen.
+#
+# The MIT License (MIT)
+#
+# Copyright (c) 2017 Louis-Philippe Lemieux Perreault
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+
+import numpy as np
+from numba import njit
+
+
+__author__ = "Louis-Philippe Lemieux Perreault"
+__copyright__ = "Copyright 2017 Louis-Philippe Lemieux Perreault"
+__license__ = "MIT"
+
+
+__all__ = ["layout_2_dosage", "unpack_bits"]
+
+
+@njit(cache=True, nogil=True)
+def layout_2_dosage(raw, max_value, prob_t, missing_data, dosage):
+    """Computes the dosage from the raw probabilities (layout 2).
+
+    Args:
+        raw (numpy.ndarray): The raw probabilities (two values per sample).
+        max_value (float): The value of a probability of 1 (``2**b - 1``).
+        prob_t (float): The probability threshold.
+        missing_data (numpy.ndarray): Whether each sample is missing.
+        dosage (numpy.ndarray): The array to fill with the dosage.
+
+    The probabilities are scaled, summed and compared to the threshold in a
+    single pass (missing samples included), without any intermediate array.
+    The GIL is released, so that threads can decode variants in parallel.
+
+    """
+    for i in range(dosage.shape[0]):
+        if missing_data[i]:
+            dosage[i] = np.nan
+            continue
+
+        p_aa = raw[2 * i] / max_value
+        p_ab = raw[2 * i + 1] / max_value
+        p_bb = 1 - (p_aa + p_ab)
+
+        dosage[i] = 2 * p_bb + p_ab
+
+        # Setting low quality to NaN
+        if prob_t > 0:
+            if p_aa < prob_t and p_ab < prob_t and p_bb < prob_t:
+                dosage[i] = np.nan
+
+
+@njit(cache=True, nogil=True)
+def unpack_bits(data, b, values):
+    """Unpacks values stored using ``b`` bits (layout 2).
+
+    Args:
+        data (numpy.ndarray): The packed values (as bytes).
+        b (int): The number of bits used to store each value (at most 32).
+        values (numpy.ndarray): The array to fill with the values.
+
+    The bytes are added to a 64 bits buffer (least significant bits first)
+    until it contains the next value, which is then shifted out. The bounds of
+    ``data`` are not checked.
+
+    """
+    mask = (np.uint64(1) << np.uint64(b)) - np.uint64(1)
+
+    buffer = np.uint64(0)
+    nb_bits = 0
+    position = 0
+    for i in range(values.shape[0]):
+        # Filling the buffer with enough bits
+        while nb_bits < b:
+            buffer |= np.uint64(data[position]) << np.uint64(nb_bits)
+            nb_bits += 8
+            position += 1
+
+        values[i] = buffer & mask
+        buffer >>= np.uint64(b)
+        nb_bits -= b
@@ -25,14 +25,19 @@
 # THE SOFTWARE.
 
 
-from __future__ import division
-
+import os
 import logging
+import threading
 import multiprocessing
+from itertools import islice
+from contextlib import closing
+from collections import deque, OrderedDict
+from multiprocessing import shared_memory
+from multiprocessing.pool import ThreadPool
 
-from six.moves import range
+import numpy as np
 
-from .pybgen import PyBGEN
+from .pybgen import PyBGEN, _Variant
 
 
 __author__ = "Louis-Philippe Lemieux Perreault"
@@ -47,13 +52,141 @@ __all__ = ["ParallelPyBGEN"]
 logger = logging.getLogger(__name__)
 
 
-def _pybgen_reader(fn, prob_t, probs_only, seeks, queue):
-    """Reads specific markers according to a seek queue."""
-    with PyBGEN(fn, mode="r", prob_t=prob_t, probs_only=probs_only,
-                _skip_index=True) as bgen:
-        for r in bgen._iter_seeks(seeks):
-            queue.put(r)
-    queue.put(None)
+# The state of a worker (thread local, so that it also works for threads)
+_worker = threading.local()
+
+
+def _init_worker(fn, prob_t, probs_only, shm, quantized, decode_threads,
+                 cores, worker_counter):
+    """Initializes a worker (opens the BGEN file once for all tasks).
+
+    If ``shm`` is provided (the name of the shared memory block and the size
+    of a slot), the data is written in the shared memory block, and only the
+    slot number is sent back. If ``quantized`` is ``True``, the raw (integer)
+    probabilities are sent back instead of the probabilities. If
+    ``decode_threads`` is greater than 1, the variants are decoded by a pool
+    of threads while the worker reads the following ones. If ``cores`` is
+    provided, the worker is pinned to one of them (according to its number in
+    the pool, given by ``worker_counter``).
+
+    """
+    if cores is not None:
+        with worker_counter.get_lock():
+            worker_number = worker_counter.value
+            worker_counter.value += 1
+        os.sched_setaffinity(0, {cores[worker_number % len(cores)]})
+
+    _init_decoder(fn, prob_t, probs_only, quantized)
+
+    _worker.ring = None
+    if shm is not None:
+        shm_name, _worker.slot_size = shm
+        _worker.ring = shared_memory.SharedMemory(name=shm_name)
+
+    _worker.decoders = None
+    if decode_threads > 1:
+        _worker.decoders = ThreadPool(
+            decode_threads, initializer=_init_decoder,
+            initargs=(fn, prob_t, probs_only, quantized),
+        )
+
+
+def _init_decoder(fn, prob_t, probs_only, quantized):
+    """Initializes a decoder (with its own BGEN file and decompressor)."""
+    _worker.bgen = PyBGEN(fn, mode="r", prob_t=prob_t, probs_only=probs_only,
+                          _skip_index=True)
+    _worker.quantized = quantized
+
+
+def _get_cores():
+    """Gets the available cores (one per physical core first).
+
+    The hyperthreads of a physical core share its caches, so they are only
+    used once all the physical cores have a worker.
+
+    """
+    topology = "/sys/devices/system/cpu/cpu{}/topology/{}"
+
+    physical_cores = set()
+    cores = []
+    siblings = []
+    for core in sorted(os.sched_getaffinity(0)):
+        try:
+            with open(topology.format(core, "physical_package_id")) as f:
+                package_id = f.read().strip()
+            with open(topology.format(core, "core_id")) as f:
+                core_id = f.read().strip()
+            physical_core = (package_id, core_id)
+
+        except (IOError, OSError):
+            physical_core = core
+
+        if physical_core in physical_cores:
+            siblings.append(core)
+            continue
+
+        physical_cores.add(physical_core)
+        cores.append(core)
+
+    return tuple(cores + siblings)
+
+
+def _decode_block(variant_block):
+    """Decodes a variant's probability block.
+
+    When ``quantized``, the raw probabilities (layout 2) are stored using the
+    smallest unsigned integer type fitting the number of bits of the file
+    (e.g. one byte for 8 bits), which is a lot smaller to pickle than the
+    probabilities (three float64 values per sample). The transformation is
+    done by the main process.
+
+    """
+    variant, block = variant_block
+    if not _worker.quantized:
+        return variant, _worker.bgen._get_curr_variant_data(block)
+
+    raw, b, missing_data = _worker.bgen._get_curr_variant_raw_probs_layout_2(
+        block,
+    )
+    return variant, raw.astype(np.min_scalar_type(2**b - 1)), b, missing_data
+
+
+def _worker_decode(seeks, first_slot=None):
+    """Reads a batch of markers according to their seek positions.
+
+    The results are sent back in a single batch, so that the result queue's
+    lock (and the pickling for processes) is paid once per batch instead of
+    once per variant. When using shared memory, the batch's variants are
+    written in the consecutive slots starting at ``first_slot`` (if it is
+    ``None``, the data is sent back with the variants).
+
+    """
+    # The blocks are read sequentially (and decoded by the decoders, if any,
+    # while the following blocks are being read)
+    blocks = _worker.bgen._iter_seeks_blocks(seeks)
+    if _worker.decoders is None:
+        results = map(_decode_block, blocks)
+    else:
+        results = _worker.decoders.imap(_decode_block, blocks)
+
+    if _worker.quantized:
+        return list(results)
+
+    batch = []
+    for i, (variant, data) in enumerate(results):
+        if first_slot is None:
+            batch.append((variant, data))
+            continue
+
+        # Copying the data in the variant's slot
+        slot = first_slot + i
+        np.ndarray(
+            data.shape, dtype=data.dtype, buffer=_worker.ring.buf,
+            offset=slot * _worker.slot_size,
+        )[...] = data
+        batch.append((variant, slot, data.shape, data.dtype.str))
+
+    return batch
 
 
 class ParallelPyBGEN(PyBGEN):
@@ -64,9 +197,71 @@ class ParallelPyBGEN(PyBGEN):
         prob_t (float): The probability threshold (optional).
         cpus (int): The number of CPUs (default is 2).
         probs_only (boolean): Return only the probabilities instead of dosage.
-        max_variants (int): The maximal number of variants in the Queue
-
-    Reads a BGEN file using multiple processes.
+        max_variants (int): The maximal number of variants being read ahead.
+        threads (boolean): Use threads instead of processes.
+        batch_size (int): The maximal number of variants read by a worker at
+                          once.
+        use_shared_memory (boolean): Transfer the data using shared memory
+                                     (processes only).
+        cache_size (int): The number of decoded variants to keep in memory
+                          (default is 0, no cache).
+        prefetch_depth (int): The number of batches read ahead by the workers
+                              (default is twice the number of CPUs).
+        decode_threads (int): The number of threads decoding the variants in
+                              each worker (processes only, default is 1).
+        pin_workers (boolean): Pin each worker to its own core (processes
+                               on Linux only, default is False).
+        cache_seeks (boolean): Save the variants' seek positions next to the
+                               index file (default is False).
+        create_indexes (boolean): Create the SQL indexes missing from the
+                                  index file (default is True).
+
+    Reads a BGEN file using a pool of processes. The pool (and the BGEN file
+    opened by each of its workers) is created on the first iteration and is
+    reused by the following ones (and shared by the iterations running at
+    the same time), until the object is closed. The workers read up to
+    ``prefetch_depth`` batches ahead of the variant being consumed (and
+    never more than ``max_variants`` variants), so that the next variants
+    are already decoded when they are requested. When
+    ``threads`` is ``True``, the workers are threads sharing the same
+    interpreter. This removes the cost of spawning processes and of pickling
+    the results, and the decompression (zlib and zstandard) still runs in
+    parallel since it releases the GIL.
+
+    When ``use_shared_memory`` is ``True``, the workers write
+    the data in a ring of shared memory slots (one slot per variant),
+    and only the slot numbers and the variants' information are sent back.
+    The ring is only managed by the main process, which gives its own range
+    of slots to each batch being read, so no lock is required. Only one
+    iteration uses the ring at a time (the iterations running at the same
+    time get their data with the variants, as if there was no ring).
+
+    When ``decode_threads`` is greater than 1, each worker only reads the
+    variants from the file, and a pool of threads decompresses and decodes
+    them at the same time (zlib and zstandard release the GIL). This helps
+    when there are more CPUs than workers (e.g. when the number of workers
+    is limited by the number of open files or the memory).
+
+    When ``pin_workers`` is ``True``, each worker is pinned to its own core
+    (physical cores first, then their hyperthreads), so that it is not moved
+    from one core to another by the scheduler (losing its cached data).
+
+    When only the probabilities are required from a layout 2 file (and the
+    workers are processes not using shared memory), the workers send back
+    the raw integer probabilities (e.g. one byte per value for a file using 8
+    bits), and the main process computes the probabilities.
+
+    When ``cache_size`` is greater than 0, the last decoded variants are kept
+    in memory (least recently used first out), so that they are not read and
+    decompressed again when they are requested a second time (e.g. when
+    calling :py:meth:`iter_variants_by_names` repeatedly). Note that the cache
+    only helps when the same variants are accessed again: on a single pass
+    over the file, it only adds memory usage and copies.
+
+    When ``cache_seeks`` is ``True``, the seek positions of all the variants
+    are saved in a ``.seeks.npy`` file next to the BGEN file the first time
+    they are required. When the file is opened again, the seek positions are
+    loaded (memory mapped) from this file instead of scanning the index.
 
     .. code-block:: python
 
@@ -79,26 +274,101 @@ class ParallelPyBGEN(PyBGEN):
     """
 
     def __init__(self, fn, prob_t=0.9, cpus=2, probs_only=False,
-                 max_variants=1000):
+                 max_variants=1000, threads=False, batch_size=64,
+                 use_shared_memory=False, cache_size=0, prefetch_depth=None,
+                 cache_seeks=False, decode_threads=1, pin_workers=False,
+                 create_indexes=True):
         """Initializes a new PyBGEN instance."""
         # Calling the parent's constructor
-        super(ParallelPyBGEN, self).__init__(
+        super().__init__(
             fn, mode="r", prob_t=prob_t, probs_only=probs_only,
+            create_indexes=create_indexes,
         )
 
-        # Initializing the queue and process
+        # Initializing the pool (created on first use)
         self.cpus = cpus
         self._max_variants = max_variants
+        self._threads = threads
+        self._batch_size = batch_size
         self._seeks = None
+        self._cache_seeks = cache_seeks
+
+        # The threads decoding the variants in each worker (useless for
+        # threads, since there are already enough of them)
+        self._decode_threads = 1 if threads else decode_threads
+
+        # The cores on which the workers are pinned (if required)
+        self._cores = None
+        if pin_workers and not threads:
+            if not hasattr(os, "sched_setaffinity"):
+                raise ValueError("pinning the workers requires Linux")
+            self._cores = _get_cores()
+
+        # The number of batches read ahead
+        self._prefetch_depth = prefetch_depth
+        if prefetch_depth is None:
+            self._prefetch_depth = 2 * cpus
+        self._prefetch_depth = min(
+            self._prefetch_depth, max(1, max_variants // batch_size),
+        )
+        self._pool = None
+
+        # The number of iterations using the pool (which is only terminated
+        # when none of them is running anymore)
+        self._nb_iterations = 0
+
+        # The cache of decoded variants (seek position -> variant and data)
+        self._cache_size = cache_size
+        self._cache = OrderedDict() if cache_size > 0 else None
+
+        # The shared memory ring (useless for threads)
+        self._shm = None
+        self._ring_in_use = False
+        if use_shared_memory and not threads:
+            self._create_shm_ring()
+
+        # Sending the raw probabilities (only useful if they are pickled)
+        self._quantized = (
+            probs_only and self._layout == 2 and not threads and
+            self._shm is None
+        )
+
+    def close(self):
+        """Closes the BGEN object."""
+        super().close()
+
+        # Stopping the workers
+        self._close_pool()
+
+        # Releasing the shared memory
+        if self._shm is not None:
+            self._shm.close()
+            self._shm.unlink()
+            self._shm = None
+
+    def _create_shm_ring(self):
+        """Creates the ring of shared memory slots."""
+        # A slot contains a single variant (stored as float64)
+        self._slot_size = self._nb_samples * 8
+        if self._return_probs:
+            self._slot_size *= 3
+
+        # There is one range of slots per batch being read ahead, plus the
+        # range of the batch being consumed
+        self._nb_slot_ranges = self._prefetch_depth + 1
+        self._nb_slots = self._nb_slot_ranges * self._batch_size
+
+        self._shm = shared_memory.SharedMemory(
+            create=True, size=self._nb_slots * self._slot_size,
+        )
 
     def iter_variants(self):
         """Iterates over all variants using multiple process."""
         # Getting tall the variants seek position
         if self._seeks is None:
             self._get_all_seeks()
-        seeks = [self._seeks[i::self.cpus] for i in range(self.cpus)]
 
-        return self._parallel_iter_seeks(seeks)
+        return self._parallel_iter_seeks(self._split_seeks(self._seeks))
 
     def iter_variants_by_names(self, names):
         """Iterates over variants using a list of names.
@@ -108,49 +378,306 @@ class ParallelPyBGEN(PyBGEN):
 
         """
         seeks = self._get_seeks_for_names(names)
-        seeks = [seeks[i::self.cpus] for i in range(self.cpus)]
 
-        return self._parallel_iter_seeks(seeks)
+        return self._parallel_iter_seeks(self._split_seeks(seeks))
+
+    def iter_variants_in_region(self, chrom, start, end):
+        """Iterates over variants in a specific region using multiple process.
+
+        Args:
+            chrom (str): The name of the chromosome.
+            start (int): The starting position of the region.
+            end (int): The ending position of the region.
+
+        """
+        # The variants' information comes from the index file (like for
+        # PyBGEN), and only their data from the workers
+        return self._parallel_iter_index_variants(
+            self._fetch_region(chrom, start, end),
+        )
+
+    def _parallel_iter_index_variants(self, rows):
+        """Iterates over variants using their information from the index.
+
+        Args:
+            rows (list): The seek position, the name, the chromosome, the
+                         position and the two alleles of the variants.
+
+        The variants are returned in the order of their seek positions, so
+        each one comes with the data read by the workers at its position.
+
+        """
+        seeks = np.fromiter(
+            (row[0] for row in rows), dtype=np.int64, count=len(rows),
+        )
+
+        results = self._parallel_iter_seeks(self._split_seeks(seeks))
+        with closing(results):
+            for (_, data), (_, name, chrom, pos, a1, a2) in zip(results, rows):
+                yield _Variant(name, chrom, pos, a1, a2), data
+
+    def _split_seeks(self, seeks):
+        """Splits the seeks into contiguous blocks (one per CPU).
+
+        Each block is a contiguous region of the file, so that the variants
+        of a batch are read sequentially (and benefit from the readahead).
+        The last block contains the remaining seeks.
+
+        """
+        size = len(seeks) // self.cpus
+        blocks = [seeks[i*size:(i+1)*size] for i in range(self.cpus - 1)]
+        blocks.append(seeks[(self.cpus - 1)*size:])
+
+        return blocks
 
     def _get_all_seeks(self):
         """Gets the list of seeks."""
-        self._bgen_index.execute("SELECT file_start_position FROM Variant")
-        seeks = [_[0] for _ in self._bgen_index.fetchall()]
-        seeks.sort()
-        self._seeks = tuple(seeks)
-
-    def _spawn_workers(self, seeks, queue):
-        """Spawn some workers."""
-        self._workers = []
-        for i in range(self.cpus):
-            worker = multiprocessing.Process(
-                target=_pybgen_reader,
-                args=(self._bgen.name, self.prob_t, self._return_probs,
-                      seeks[i], queue),
-            )
-            self._workers.append(worker)
-            worker.start()
+        # The seeks might have been saved from a previous run
+        seeks_fn = self._bgen.name + ".seeks.npy"
+        if self._cache_seeks and self._is_seeks_file_valid(seeks_fn):
+            self._seeks = np.load(seeks_fn, mmap_mode="r")
+            return
+
+        # The rows are sorted by sqlite, and read directly from the cursor
+        # into an array
+        self._bgen_index.execute("SELECT COUNT(*) FROM Variant")
+        nb_seeks = self._bgen_index.fetchone()[0]
+        self._bgen_index.execute(
+            "SELECT file_start_position FROM Variant "
+            "ORDER BY file_start_position",
+        )
+        self._seeks = self._fetch_seeks(nb_seeks)
+
+        if self._cache_seeks:
+            self._save_seeks(seeks_fn)
+
+    def _is_seeks_file_valid(self, fn):
+        """Checks if the seeks file exists and is up to date."""
+        if not os.path.isfile(fn):
+            return False
+
+        # The index might have been modified after the seeks were saved
+        if os.path.getmtime(fn) < os.path.getmtime(self._bgen.name + ".bgi"):
+            return False
+
+        return np.load(fn, mmap_mode="r").shape == (self._nb_variants, )
+
+    def _save_seeks(self, fn):
+        """Saves the seeks (the file is renamed once it is complete)."""
+        tmp_fn = fn + ".tmp"
+        try:
+            with open(tmp_fn, "wb") as f:
+                np.save(f, self._seeks)
+            os.rename(tmp_fn, fn)
+
+        except (IOError, OSError):
+            logger.warning("%s: unable to save the seek positions", fn)
+
+    def _get_pool(self):
+        """Gets the pool of workers (creating it if required)."""
+        if self._pool is not None:
+            return self._pool
+
+        shm = None
+        if self._shm is not None:
+            shm = (self._shm.name, self._slot_size)
+
+        # The workers number themselves in this pool (for their core)
+        worker_counter = None
+        if self._cores is not None:
+            worker_counter = multiprocessing.Value("i", 0)
+
+        pool_class = ThreadPool if self._threads else multiprocessing.Pool
+        self._pool = pool_class(
+            self.cpus, initializer=_init_worker,
+            initargs=(self._bgen.name, self.prob_t, self._return_probs, shm,
+                      self._quantized, self._decode_threads, self._cores,
+                      worker_counter),
+        )
+
+        return self._pool
+
+    def _close_pool(self):
+        """Closes the pool of workers (if any).
+
+        The workers exit cleanly once they have finished their current task
+        (the pool sends them a sentinel), and they are joined.
+
+        """
+        if self._pool is None:
+            return
+
+        self._pool.close()
+        self._pool.join()
+        self._pool = None
+
+    def _terminate_pool(self):
+        """Terminates the pool of workers (if any).
+
+        This is only required when the workers are still busy reading
+        variants that won't be consumed (and when no other iteration is
+        using them).
+
+        """
+        if self._pool is None:
+            return
+
+        self._pool.terminate()
+        self._pool.join()
+        self._pool = None
+
+    def _cache_variant(self, seek, result):
+        """Adds a variant to the cache (removing the least recently used)."""
+        variant, data = result
+        self._cache[seek] = (variant, data.copy())
+        if len(self._cache) > self._cache_size:
+            self._cache.popitem(last=False)
+
+    def _get_cached_variant(self, seek):
+        """Gets a variant from the cache (marking it as recently used)."""
+        variant, data = self._cache.pop(seek)
+        self._cache[seek] = (variant, data)
+        return variant, data.copy()
+
+    def _copy_from_slot(self, variant, slot, shape, dtype):
+        """Copies a variant's data out of a shared memory slot."""
+        data = np.ndarray(
+            shape, dtype=dtype, buffer=self._shm.buf,
+            offset=slot * self._slot_size,
+        ).copy()
+        return variant, data
+
+    def _dequantize(self, variant, raw, b, missing_data):
+        """Computes a variant's probabilities from its raw probabilities."""
+        return variant, self._layout_2_raw_probs_to_probs(
+            raw, b, missing_data,
+        )
+
+    def _submit_batch(self, pool, seeks_batch, batch_number, use_ring):
+        """Submits a batch of seeks to the pool of workers."""
+        # The range of shared memory slots for this batch (there are enough
+        # ranges so that the one being consumed is never reused)
+        first_slot = None
+        if use_ring:
+            first_slot = batch_number % self._nb_slot_ranges
+            first_slot *= self._batch_size
+
+        return seeks_batch, pool.apply_async(
+            _worker_decode, (seeks_batch, first_slot),
+        )
 
     def _parallel_iter_seeks(self, seeks):
-        """Iterates over variants using multiple process."""
-        # Spanning processes
-        queue = multiprocessing.Queue(self._max_variants)
-        self._spawn_workers(seeks, queue)
+        """Iterates over variants using multiple process.
+
+        The variants are returned in the order of the seeks (the cached
+        variants being returned at their position, between the variants read
+        by the workers).
 
-        # Launching the analysis
+        """
+        # The variants in the cache are not read again (they are kept by
+        # position in the seeks)
+        cached = {}
+        if self._cache is not None:
+            cached = {
+                position: self._get_cached_variant(seek)
+                for position, seek in enumerate(
+                    seek for worker_seeks in seeks for seek in worker_seeks
+                )
+                if seek in self._cache
+            }
+            seeks = [
+                [seek for seek in worker_seeks if seek not in self._cache]
+                for worker_seeks in seeks
+            ]
+
+        # Splitting the seeks into batches (smaller than the maximal batch size
+        # when there are few seeks, so that all the workers get some)
+        nb_seeks = sum(len(worker_seeks) for worker_seeks in seeks)
+        batch_size = max(1, min(self._batch_size, nb_seeks // (self.cpus * 8)))
+        batches = [
+            worker_seeks[i:i+batch_size]
+            for worker_seeks in seeks
+            for i in range(0, len(worker_seeks), batch_size)
+        ]
+
+        # The workers are only required if there is something to read
+        pool = self._get_pool() if batches else None
+        batches = enumerate(batches)
+
+        # The shared memory ring is only used by one iteration at a time
+        use_ring = self._shm is not None and not self._ring_in_use
+
+        pending = deque()
+        position = 0
+        finished = False
+        self._nb_iterations += 1
+        self._ring_in_use |= use_ring
         try:
-            nb_finish = 0
-            while True:
-                if nb_finish >= self.cpus:
-                    break
+            for i, seeks_batch in islice(batches, self._prefetch_depth):
+                pending.append(
+                    self._submit_batch(pool, seeks_batch, i, use_ring),
+                )
+
+            # The first cached variants are returned while the workers are
+            # busy
+            while position in cached:
+                yield cached.pop(position)
+                position += 1
+
+            while pending:
+                batch_seeks, batch = pending.popleft()
+                batch = batch.get()
+
+                # Keeping the workers busy
+                for i, seeks_batch in islice(batches, 1):
+                    pending.append(
+                        self._submit_batch(pool, seeks_batch, i, use_ring),
+                    )
 
-                result = queue.get()
-                if result is None:
-                    nb_finish += 1
-                    continue
-                yield result
+                for seek, result in zip(batch_seeks, batch):
+                    # Copying the data out of the shared memory slots
+                    if use_ring:
+                        result = self._copy_from_slot(*result)
+
+                    elif self._quantized:
+                        result = self._dequantize(*result)
+
+                    if self._cache is not None:
+                        self._cache_variant(seek, result)
+
+                    yield result
+                    position += 1
+
+                    # The cached variants following this one
+                    while position in cached:
+                        yield cached.pop(position)
+                        position += 1
+
+            finished = True
 
         finally:
-            # Terminating the worker, whatever happened
-            for worker in self._workers:
-                worker.terminate()
+            self._nb_iterations -= 1
+            if not finished:
+                self._abandon_batches(pending, use_ring)
+            if use_ring:
+                self._ring_in_use = False
+
+    def _abandon_batches(self, pending, use_ring):
+        """Discards the pending batches of an iteration stopped early.
+
+        The workers might still be reading variants that won't be consumed
+        (and writing in shared memory slots). They are stopped if no other
+        iteration is using them. Otherwise, the batches are left to finish
+        (their results are ignored), but those writing in the shared memory
+        slots are waited for, so that the ring can be used again.
+
+        """
+        if not pending:
+            return
+
+        if self._nb_iterations == 0:
+            self._terminate_pool()
+
+        elif use_ring:
+            for _, batch in pending:
+                batch.wait()
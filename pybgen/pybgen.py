@@ -25,27 +25,51 @@
 # THE SOFTWARE.
 
 
-from __future__ import division
-
 import os
-import sys
+import mmap
 import zlib
+import queue
 import logging
 import sqlite3
+import threading
 from math import ceil
-from struct import unpack
+from collections import OrderedDict
+from struct import Struct, error as struct_error
 from io import UnsupportedOperation
 
 import numpy as np
 
-from six.moves import range
-
 try:
     import zstandard as zstd
     HAS_ZSTD = True
 except ImportError:
     HAS_ZSTD = False
 
+try:
+    from isal import isal_zlib
+    HAS_ISAL = True
+except ImportError:
+    HAS_ISAL = False
+
+try:
+    from ._numba_kernels import layout_2_dosage as _layout_2_dosage_kernel
+    from ._numba_kernels import unpack_bits as _unpack_bits_kernel
+    HAS_NUMBA = True
+except ImportError:
+    HAS_NUMBA = False
+
+# The Cython kernels (if they were built) are used when numba isn't installed
+HAS_CYTHON = False
+if not HAS_NUMBA:
+    try:
+        from ._decode import layout_2_dosage as _layout_2_dosage_kernel
+        from ._decode import unpack_bits as _unpack_bits_kernel
+        HAS_CYTHON = True
+    except ImportError:
+        pass
+
+HAS_KERNELS = HAS_NUMBA or HAS_CYTHON
+
 
 __author__ = "Louis-Philippe Lemieux Perreault"
 __copyright__ = "Copyright 2017 Louis-Philippe Lemieux Perreault"
@@ -59,11 +83,57 @@ __all__ = ["PyBGEN"]
 logger = logging.getLogger(__name__)
 
 
-# The python version
-PYTHON_VERSION = sys.version_info.major
+# The maximal number of variables in a SQL statement (SQLite's default)
+_MAX_SQL_VARIABLES = 999
+
+
+# The number of bytes read at once to parse a variant's information (it is
+# enough for most variants, and it is increased for the others)
+_VARIANT_INFO_SIZE = 1024
+
+
+# The (little endian) integers of the BGEN file
+_UINT16 = Struct("<H")
+_UINT32 = Struct("<I")
+
+
+# The markers' information (as returned by iter_variant_info_arrays)
+_VARIANT_INFO_DTYPE = [("name", "O"), ("chrom", "O"), ("pos", "i8"),
+                       ("a1", "O"), ("a2", "O")]
+
 
+# The number of names whose seek positions are cached (for get_variant)
+_NAME_SEEKS_CACHE_SIZE = 1024
 
-class _Variant(object):
+
+# The number of compiled SQL statements kept by the index's connection
+_SQL_CACHED_STATEMENTS = 256
+
+
+# The SQL indexes required by the index file's queries (their name, the number
+# of searched columns and their columns, which include the seek position so
+# that the table isn't read)
+_SQL_INDEXES = (
+    ("pybgen_rsid", 1, ("rsid", "file_start_position")),
+    ("pybgen_region", 2, ("chromosome", "position", "file_start_position")),
+)
+
+
+# The types of the raw probabilities read directly from the data (layout 2)
+_RAW_PROBS_DTYPES = {8: np.uint8, 16: np.uint16, 32: np.uint32}
+
+
+# The number of seconds a pipeline's thread waits on a queue before checking if
+# the iteration was stopped
+_PIPELINE_TIMEOUT = 0.1
+
+
+# The initial size of the buffer used to read the probability blocks (it is
+# increased to the largest block of the file)
+_READ_BUFFER_SIZE = 1 << 16
+
+
+class _Variant:
     __slots__ = ("name", "chrom", "pos", "a1", "a2")
 
     def __init__(self, name, chrom, pos, a1, a2):
@@ -79,7 +149,43 @@ class _Variant(object):
         )
 
 
-class PyBGEN(object):
+class _MappedFile(mmap.mmap):
+    """A read only memory mapped file.
+
+    Args:
+        fn (str): The name of the file.
+
+    The mapping has the methods of a file object required to read the BGEN
+    file (:py:meth:`read`, :py:meth:`readinto`, :py:meth:`seek` and
+    :py:meth:`tell`), but reading it doesn't require a system call.
+
+    """
+
+    def __new__(cls, fn):
+        with open(fn, "rb") as f:
+            self = super().__new__(
+                cls, f.fileno(), 0, access=mmap.ACCESS_READ,
+            )
+        self.name = fn
+        return self
+
+    def readinto(self, buffer):
+        """Reads data into a buffer (like a file object)."""
+        start = self.tell()
+        size = min(len(buffer), len(self) - start)
+
+        # The view is released, so that the mapping can be closed
+        view = memoryview(self)
+        try:
+            buffer[:size] = view[start:start+size]
+        finally:
+            view.release()
+
+        self.seek(start + size)
+        return size
+
+
+class PyBGEN:
     """Reads and store a set of BGEN files.
 
     Args:
@@ -87,9 +193,24 @@ class PyBGEN(object):
         mode (str): The open mode for the BGEN file.
         prob_t (float): The probability threshold (optional).
         probs_only (boolean): Return only the probabilities instead of dosage.
+        prefetch (int): The number of variants read and decoded ahead by
+                        :py:meth:`iter_variants` (default is 0, no pipeline).
+        create_indexes (boolean): Create the SQL indexes missing from the
+                                  index file (default is True).
 
     Reads or write BGEN files.
 
+    When ``prefetch`` is greater than 1, :py:meth:`iter_variants` uses a
+    pipeline of two threads (each with its own BGEN file): the first one
+    reads the variants' probability blocks, and the second one decompresses
+    and decodes them (zlib and zstandard release the GIL), while the
+    previous variants are being consumed.
+
+    When ``create_indexes`` is ``True``, the indexes required by the name and
+    region lookups are added to the index file (which is modified) if it
+    doesn't have them. If the index file can't be modified, the lookups scan
+    the index's table instead.
+
     .. code-block:: python
 
         from pybgen import PyBGEN
@@ -101,7 +222,7 @@ class PyBGEN(object):
     """
 
     def __init__(self, fn, mode="r", prob_t=0.9, _skip_index=False,
-                 probs_only=False):
+                 probs_only=False, prefetch=0, create_indexes=True):
         """Initializes a new PyBGEN instance."""
         # The mode
         self._mode = mode
@@ -109,11 +230,23 @@ class PyBGEN(object):
         # What to return
         self._return_probs = probs_only
 
+        # The number of variants read ahead (by iter_variants)
+        self._prefetch = prefetch
+
         if self._mode == "r":
-            # Parsing the file
-            self._bgen = open(fn, "rb")
+            # Parsing the file (memory mapped, unless it can't be mapped,
+            # e.g. if it is empty)
+            try:
+                self._bgen = _MappedFile(fn)
+            except (ValueError, EnvironmentError):
+                self._bgen = open(fn, "rb")
+            self._read_buffer = bytearray(_READ_BUFFER_SIZE)
+            self._variant_info_size = _VARIANT_INFO_SIZE
             self._parse_header()
 
+            # Choosing how to decode the variants
+            self._set_decoder()
+
             # Did the samples were parsed?
             if not self._has_sample:
                 self._samples = None
@@ -123,7 +256,13 @@ class PyBGEN(object):
             if not _skip_index:
                 if not os.path.isfile(fn + ".bgi"):
                     raise IOError("{}: no such file".format(fn + ".bgi"))
-                self._connect_index()
+                self._connect_index(create_indexes)
+
+            # The seek positions of the last names (least recently used last)
+            self._name_seeks_cache = OrderedDict()
+
+            # The scales of the raw probabilities (by number of bits and type)
+            self._probs_scales = {}
 
             # The probability
             self.prob_t = prob_t
@@ -236,12 +375,87 @@ class PyBGEN(object):
         if self._mode != "r":
             raise UnsupportedOperation("not available in 'w' mode")
 
+        # Reading and decoding the variants ahead (in other threads)
+        if self._prefetch > 1:
+            return self._iter_variants_pipeline()
+
         # Seeking back to the first variant block
         self._bgen.seek(self._first_variant_block)
 
         # Return itself (the generator)
         return self
 
+    def _iter_variants_pipeline(self):
+        """Iterates over all the variants using a pipeline of threads.
+
+        The variants are read by a first thread, and decoded by a second one
+        (each one with its own BGEN file, so that they don't move the file
+        position or use the decompressor of this object). Each stage sends
+        at most ``prefetch`` variants ahead.
+
+        """
+        stop = threading.Event()
+        blocks = queue.Queue(self._prefetch)
+        variants = queue.Queue(self._prefetch)
+
+        reader = PyBGEN(self._bgen.name, prob_t=self.prob_t,
+                        probs_only=self._return_probs, _skip_index=True)
+        decoder = PyBGEN(self._bgen.name, prob_t=self.prob_t,
+                         probs_only=self._return_probs, _skip_index=True)
+
+        # The threads are named after this object (to be told apart from
+        # the ones of other readers)
+        threads = [
+            threading.Thread(
+                target=_pipeline_stage,
+                name="pybgen-{:x}-reader".format(id(self)),
+                args=(reader._iter_all_blocks(), blocks, stop),
+            ),
+            threading.Thread(
+                target=_pipeline_stage,
+                name="pybgen-{:x}-decoder".format(id(self)),
+                args=(_iter_pipeline_queue(blocks, stop), variants, stop,
+                      decoder._decode_variant_block),
+            ),
+        ]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+        try:
+            for item in _iter_pipeline_queue(variants, stop):
+                if isinstance(item, _PipelineError):
+                    raise item.exception
+                yield item
+
+        finally:
+            # Stopping the threads (if the iteration ended early)
+            stop.set()
+            for thread in threads:
+                thread.join()
+            reader.close()
+            decoder.close()
+
+    def _iter_all_blocks(self):
+        """Iterates over all the variants (without decoding them).
+
+        Yields the variants and their probability blocks (from the first
+        variant of the file), like :py:meth:`_iter_seeks_blocks`.
+
+        """
+        self._bgen.seek(self._first_variant_block)
+        for _ in range(self._nb_variants):
+            _, rs_id, chrom, pos, alleles = self._get_curr_variant_info()
+            yield (
+                _Variant(rs_id, chrom, pos, *alleles),
+                self._read_curr_variant_block(),
+            )
+
+    def _decode_variant_block(self, variant_block):
+        """Decodes a variant's probability block (keeping the variant)."""
+        variant, block = variant_block
+        return variant, self._get_curr_variant_data(block)
+
     def iter_variants_in_region(self, chrom, start, end):
         """Iterates over variants in a specific region.
 
@@ -251,18 +465,33 @@ class PyBGEN(object):
             end (int): The ending position of the region.
 
         """
-        # Getting the region from the index file
+        # The variants' information comes from the index file, so that it
+        # isn't decoded from the BGEN file
+        return self._iter_index_variants(self._fetch_region(chrom, start, end))
+
+    def _fetch_region(self, chrom, start, end):
+        """Fetches the variants of a region from the index file.
+
+        Args:
+            chrom (str): The name of the chromosome.
+            start (int): The starting position of the region.
+            end (int): The ending position of the region.
+
+        Returns:
+            list: The seek position, the name, the chromosome, the position
+            and the two alleles of the variants (in the order of the file).
+
+        """
         self._bgen_index.execute(
-            "SELECT file_start_position "
+            "SELECT file_start_position, rsid, chromosome, position, allele1, "
+            "       allele2 "
             "FROM Variant "
-            "WHERE chromosome = ? AND position >= ? AND position <= ?",
+            "WHERE chromosome = ? AND position >= ? AND position <= ? "
+            "ORDER BY file_start_position",
             (chrom, start, end),
         )
 
-        # Fetching all the seek positions
-        seek_positions = [_[0] for _ in self._bgen_index.fetchall()]
-
-        return self._iter_seeks(seek_positions)
+        return self._bgen_index.fetchall()
 
     def iter_variants_by_names(self, names):
         """Iterates over variants using a list of names.
@@ -327,18 +556,98 @@ class PyBGEN(object):
                 yield _Variant(rsid, chrom, pos, a1, a2)
             results = self._bgen_index.fetchmany(array_size)
 
+    def iter_variant_info_arrays(self, chunksize=100000):
+        """Iterate over marker information (by chunks of markers).
+
+        Args:
+            chunksize (int): The maximal number of markers in each chunk.
+
+        Returns:
+            numpy.recarray: The markers' information (with the ``name``,
+            ``chrom``, ``pos``, ``a1`` and ``a2`` fields of the variants).
+
+        No variant object is created for each marker, which is a lot faster
+        when the markers are filtered (e.g. using their position).
+
+        """
+        self._bgen_index.execute(
+            "SELECT rsid, chromosome, position, allele1, allele2 FROM Variant",
+        )
+
+        # Fetching the results
+        results = self._bgen_index.fetchmany(chunksize)
+        while results:
+            yield np.array(results, dtype=_VARIANT_INFO_DTYPE).view(
+                np.recarray,
+            )
+            results = self._bgen_index.fetchmany(chunksize)
+
     def _iter_seeks(self, seeks):
         """Iterate over seek positions."""
         for seek in seeks:
             self._bgen.seek(seek)
             yield self._read_current_variant()
 
+    def _iter_index_variants(self, rows):
+        """Iterate over variants using their information from the index.
+
+        Args:
+            rows (list): The seek position, the name, the chromosome, the
+                         position and the two alleles of the variants.
+
+        The variants' information is skipped (its strings are not decoded)
+        in the BGEN file.
+
+        """
+        for seek, name, chrom, pos, a1, a2 in rows:
+            self._bgen.seek(seek)
+            self._read_curr_variant_info()
+            yield (
+                _Variant(name, chrom, pos, a1, a2),
+                self._get_curr_variant_data(),
+            )
+
+    def _iter_seeks_blocks(self, seeks):
+        """Iterate over seek positions (without decoding the variants).
+
+        Yields the variants and their probability blocks, which are decoded
+        using :py:meth:`_get_curr_variant_data`.
+
+        """
+        for seek in seeks:
+            self._bgen.seek(seek)
+            _, rs_id, chrom, pos, alleles = self._get_curr_variant_info()
+            yield (
+                _Variant(rs_id, chrom, pos, *alleles),
+                self._read_curr_variant_block(),
+            )
+
     def _get_seeks_for_names(self, names):
-        """Gets the seek values for each names."""
+        """Gets the seek values for each names (sorted by file position)."""
+        names = tuple(names)
+
+        # A small number of names is fetched using a single statement
+        if len(names) <= _MAX_SQL_VARIABLES:
+            self._bgen_index.execute(
+                "SELECT file_start_position "
+                "FROM Variant "
+                "WHERE rsid IN ({}) "
+                "ORDER BY file_start_position".format(
+                    ",".join("?" * len(names)),
+                ),
+                names,
+            )
+            return self._fetch_seeks()
+
         # Generating a temporary table that will contain the markers to extract
-        self._bgen_index.execute("CREATE TEMPORARY TABLE tnames (name text)")
+        # (the table is indexed on the name, and is reused between calls)
+        self._bgen_index.execute(
+            "CREATE TEMPORARY TABLE IF NOT EXISTS tnames "
+            "(name TEXT PRIMARY KEY) WITHOUT ROWID"
+        )
+        self._bgen_index.execute("DELETE FROM tnames")
         self._bgen_index.executemany(
-            "INSERT INTO tnames VALUES (?)",
+            "INSERT OR IGNORE INTO tnames VALUES (?)",
             [(n, ) for n in names],
         )
 
@@ -346,10 +655,25 @@ class PyBGEN(object):
         self._bgen_index.execute(
             "SELECT file_start_position "
             "FROM Variant "
-            "WHERE rsid IN (SELECT name FROM tnames)",
+            "WHERE rsid IN (SELECT name FROM tnames) "
+            "ORDER BY file_start_position",
         )
 
-        return tuple(_[0] for _ in self._bgen_index.fetchall())
+        return self._fetch_seeks()
+
+    def _fetch_seeks(self, count=-1):
+        """Fetches the seek positions from the index's current statement.
+
+        Args:
+            count (int): The number of seek positions (if known).
+
+        Returns:
+            numpy.ndarray: The seek positions (as 64 bits integers).
+
+        """
+        return np.fromiter(
+            (row[0] for row in self._bgen_index), dtype=np.int64, count=count,
+        )
 
     def get_variant(self, name):
         """Gets the values for a given variant.
@@ -365,14 +689,8 @@ class PyBGEN(object):
         if self._mode != "r":
             raise UnsupportedOperation("not available in 'w' mode")
 
-        # Fetching the variant
-        self._bgen_index.execute(
-            "SELECT file_start_position FROM Variant WHERE rsid = ?",
-            (name, )
-        )
-
         # Fetching all the seek positions
-        seek_positions = [_[0] for _ in self._bgen_index.fetchall()]
+        seek_positions = self._get_seeks_for_name(name)
 
         # Constructing the results
         results = list(self._iter_seeks(seek_positions))
@@ -382,6 +700,46 @@ class PyBGEN(object):
 
         return results
 
+    def get_variants(self, names):
+        """Gets the values for a list of variants.
+
+        Args:
+            names (list): The names of the variants.
+
+        Returns:
+            dict: The values of each variant (by name), as returned by
+            :py:meth:`get_variant`. The names that are not found are missing.
+
+        The variants are fetched using a minimal number of SQL statements, and
+        they are read in the order of the file.
+
+        """
+        if self._mode != "r":
+            raise UnsupportedOperation("not available in 'w' mode")
+
+        results = {}
+        for variant, dosage in self.iter_variants_by_names(names):
+            results.setdefault(variant.name, []).append((variant, dosage))
+
+        return results
+
+    def _get_seeks_for_name(self, name):
+        """Gets the seek positions of a name (the last ones are cached)."""
+        seek_positions = self._name_seeks_cache.pop(name, None)
+        if seek_positions is None:
+            self._bgen_index.execute(
+                "SELECT file_start_position FROM Variant WHERE rsid = ?",
+                (name, )
+            )
+            seek_positions = tuple(_[0] for _ in self._bgen_index.fetchall())
+
+            # Removing the least recently used name
+            if len(self._name_seeks_cache) >= _NAME_SEEKS_CACHE_SIZE:
+                self._name_seeks_cache.popitem(last=False)
+
+        self._name_seeks_cache[name] = seek_positions
+        return seek_positions
+
     def _read_current_variant(self):
         """Reads the current variant."""
         # Getting the variant's information
@@ -394,58 +752,129 @@ class PyBGEN(object):
 
     def _get_curr_variant_info(self):
         """Gets the current variant's information."""
-        if self._layout == 1:
-            n = unpack("<I", self._bgen.read(4))[0]
-            if n != self._nb_samples:
+        fields, pos, alleles = self._read_curr_variant_info()
+
+        var_id, rs_id, chrom = (field.decode() for field in fields)
+        return (
+            var_id, rs_id, chrom, pos,
+            tuple(allele.decode() for allele in alleles),
+        )
+
+    def _read_curr_variant_info(self):
+        """Reads the current variant's information (without decoding it).
+
+        Returns:
+            tuple: The variant's identifiers (variant id, rsid and chromosome)
+            and alleles (as bytes), and its position.
+
+        The information is read at once (instead of one field at a time), and
+        the file is then moved back to the end of the information.
+
+        """
+        size = self._variant_info_size
+        while True:
+            data = self._bgen.read(size)
+            try:
+                fields, pos, alleles, end = self._parse_variant_info(data)
+            except struct_error:
+                # The data is too short to read one of the lengths
+                end = None
+
+            if end is not None and end <= len(data):
+                break
+
+            if len(data) < size:
                 raise ValueError(
                     "{}: invalid BGEN file".format(self._bgen.name),
                 )
 
-        # Reading the variant id
-        var_id = self._bgen.read(unpack("<H", self._bgen.read(2))[0]).decode()
+            # Reading more data
+            self._bgen.seek(-len(data), 1)
+            size = size * 4 if end is None else end
 
-        # Reading the variant rsid
-        rs_id = self._bgen.read(unpack("<H", self._bgen.read(2))[0]).decode()
+        # Moving back to the end of the information
+        self._bgen.seek(end - len(data), 1)
 
-        # Reading the chromosome
-        chrom = self._bgen.read(unpack("<H", self._bgen.read(2))[0]).decode()
+        return fields, pos, alleles
+
+    def _parse_variant_info(self, data):
+        """Parses a variant's information.
+
+        Args:
+            data (bytes): The data starting with the variant's information.
+
+        Returns:
+            tuple: The variant's identifiers (variant id, rsid and chromosome),
+            its position, its alleles and the length of the information (which
+            is greater than the length of the data if it is incomplete).
+
+        """
+        offset = 0
+        if self._layout == 1:
+            n = _UINT32.unpack_from(data, offset)[0]
+            if n != self._nb_samples:
+                raise ValueError(
+                    "{}: invalid BGEN file".format(self._bgen.name),
+                )
+            offset += 4
+
+        # Reading the variant id, the rsid and the chromosome
+        fields = []
+        for _ in range(3):
+            length = _UINT16.unpack_from(data, offset)[0]
+            offset += 2
+            fields.append(data[offset:offset+length])
+            offset += length
 
         # Reading the position
-        pos = unpack("<I", self._bgen.read(4))[0]
+        pos = _UINT32.unpack_from(data, offset)[0]
+        offset += 4
 
         # Getting the number of alleles
         nb_alleles = 2
         if self._layout == 2:
-            nb_alleles = unpack("<H", self._bgen.read(2))[0]
+            nb_alleles = _UINT16.unpack_from(data, offset)[0]
+            offset += 2
 
         # Getting the alleles
         alleles = []
         for _ in range(nb_alleles):
-            alleles.append(self._bgen.read(
-                unpack("<I", self._bgen.read(4))[0]
-            ).decode())
+            length = _UINT32.unpack_from(data, offset)[0]
+            offset += 4
+            alleles.append(data[offset:offset+length])
+            offset += length
 
-        return var_id, rs_id, chrom, pos, tuple(alleles)
+        return fields, pos, alleles, offset
 
-    def _get_curr_variant_probs_layout_1(self):
-        """Gets the current variant's probabilities (layout 1)."""
-        c = self._nb_samples
-        if self._is_compressed:
-            c = unpack("<I", self._bgen.read(4))[0]
+    def _read_curr_variant_block(self, reuse_buffer=False):
+        """Reads the current variant's (compressed) probability block.
 
-        # Getting the probabilities
-        probs = np.frombuffer(
-            self._decompress(self._bgen.read(c)),
-            dtype="u2",
-        ) / 32768
-        probs.shape = (self._nb_samples, 3)
+        Args:
+            reuse_buffer (bool): Read the block into the reused read buffer
+                                 (the block is then only valid until the next
+                                 read).
 
-        return probs
+        Returns:
+            tuple: The probability block and the length of the probability
+            data after decompression (layout 2 only).
+
+        The block is only read (and not decompressed), so that it can be
+        decoded elsewhere (e.g. by another thread).
+
+        """
+        read = self._bgen.read
+        if reuse_buffer:
+            read = self._read_into_buffer
+
+        if self._layout == 1:
+            c = self._nb_samples
+            if self._is_compressed:
+                c = _UINT32.unpack(self._bgen.read(4))[0]
+
+            return read(c), None
 
-    def _get_curr_variant_probs_layout_2(self):
-        """Gets the current variant's probabilities (layout 2)."""
         # The total length C of the rest of the data for this variant
-        c = unpack("<I", self._bgen.read(4))[0]
+        c = _UINT32.unpack(self._bgen.read(4))[0]
 
         # The number of bytes to read
         to_read = c
@@ -455,135 +884,212 @@ class PyBGEN(object):
         if self._is_compressed:
             # The total length D of the probability data after
             # decompression
-            d = unpack("<I", self._bgen.read(4))[0]
+            d = _UINT32.unpack(self._bgen.read(4))[0]
             to_read = c - 4
 
-        # Reading the data and checking
-        data = self._decompress(self._bgen.read(to_read))
+        return read(to_read), d
+
+    def _read_into_buffer(self, size):
+        """Reads data into the read buffer (instead of allocating new bytes).
+
+        Args:
+            size (int): The number of bytes to read.
+
+        Returns:
+            memoryview: A view of the data that was read.
+
+        The buffer is replaced (and not resized) when it is too small, since a
+        view of the previous data might still exist.
+
+        """
+        if size > len(self._read_buffer):
+            self._read_buffer = bytearray(size)
+
+        view = memoryview(self._read_buffer)[:size]
+        return view[:self._bgen.readinto(view)]
+
+    def _get_curr_variant_probs_layout_1(self, block):
+        """Gets the current variant's probabilities (layout 1)."""
+        # Getting the probabilities
+        # (there are three probabilities of two bytes per sample)
+        data = self._decompress(block[0], self._nb_samples * 6)
+        probs = np.frombuffer(data, dtype="u2") / 32768
+        probs.shape = (self._nb_samples, 3)
+
+        return probs
+
+    def _get_curr_variant_raw_probs_layout_2(self, block):
+        """Gets the current variant's raw (unscaled) probabilities (layout 2).
+
+        Args:
+            block (tuple): The variant's probability block (as read by
+                           :py:meth:`_read_curr_variant_block`).
+
+        Returns:
+            tuple: The raw probabilities (two values per sample), the number of
+            bits used to encode each of them and the missing data.
+
+        """
+        data, d = block
+
+        # Decompressing the data and checking
+        data = self._decompress(data, d)
         if len(data) != d:
             raise ValueError(
                 "{}: invalid BGEN file".format(self._bgen.name)
             )
 
+        # The fields are read at an offset of the data, which is never sliced
+        # (so that it isn't copied)
+        offset = 0
+
         # Checking the number of samples
-        n = unpack("<I", data[:4])[0]
+        n = _UINT32.unpack_from(data, offset)[0]
         if n != self._nb_samples:
             raise ValueError(
                 "{}: invalid BGEN file".format(self._bgen.name)
             )
-        data = data[4:]
+        offset += 4
 
         # Checking the number of alleles (we only accept 2 alleles)
-        nb_alleles = unpack("<H", data[:2])[0]
+        nb_alleles = _UINT16.unpack_from(data, offset)[0]
         if nb_alleles != 2:
             raise ValueError(
                 "{}: only two alleles are "
                 "supported".format(self._bgen.name)
             )
-        data = data[2:]
+        offset += 2
 
         # TODO: Check ploidy for sexual chromosomes
         # The minimum and maximum for ploidy (we only accept ploidy of 2)
-        min_ploidy = _byte_to_int(data[0])
-        max_ploidy = _byte_to_int(data[1])
+        min_ploidy, max_ploidy = data[offset], data[offset + 1]
         if min_ploidy != 2 or max_ploidy != 2:
             raise ValueError(
                 "{}: only accepting ploidy of "
                 "2".format(self._bgen.name)
             )
-        data = data[2:]
+        offset += 2
 
         # Check the list of N bytes for missingness (since we assume only
-        # diploid values for each sample)
-        ploidy_info = np.frombuffer(data[:n], dtype=np.uint8)
-        ploidy_info = np.unpackbits(
-            ploidy_info.reshape(1, ploidy_info.shape[0]).T,
-            axis=1,
-        )
-        missing_data = ploidy_info[:, 0] == 1
-        data = data[n:]
+        # diploid values for each sample, only the most significant bit, which
+        # is set for missing samples, is required)
+        ploidy_info = np.frombuffer(data, dtype=np.uint8, count=n,
+                                    offset=offset)
+        missing_data = (ploidy_info & 0x80) != 0
+        offset += n
 
         # TODO: Permit phased data
         # Is the data phased?
-        is_phased = data[0] == 1
+        is_phased = data[offset] == 1
         if is_phased:
             raise ValueError(
                 "{}: only accepting unphased data".format(self._bgen.name)
             )
-        data = data[1:]
+        offset += 1
 
         # The number of bits used to encode each probabilities
-        b = _byte_to_int(data[0])
-        data = data[1:]
+        b = data[offset]
+        offset += 1
 
         # Reading the probabilities (don't forget we allow only for diploid
         # values)
         probs = None
-        if b == 8:
-            probs = np.frombuffer(data, dtype=np.uint8)
+        if b in _RAW_PROBS_DTYPES:
+            probs = np.frombuffer(data, dtype=_RAW_PROBS_DTYPES[b],
+                                  count=2 * n, offset=offset)
+
+        elif HAS_KERNELS:
+            # The kernel doesn't check the bounds, so the length is checked
+            probs = np.empty(2 * n, dtype=np.uint32)
+            if (len(data) - offset) * 8 < probs.shape[0] * b:
+                raise ValueError(
+                    "{}: invalid BGEN file".format(self._bgen.name)
+                )
+            _unpack_bits_kernel(
+                np.frombuffer(data, dtype=np.uint8, offset=offset), b, probs,
+            )
 
-        elif b == 16:
-            probs = np.frombuffer(data, dtype=np.uint16)
+        else:
+            probs = _pack_bits(memoryview(data)[offset:], b)
 
-        elif b == 32:
-            probs = np.frombuffer(data, dtype=np.uint32)
+        return probs, b, missing_data
 
-        else:
-            probs = _pack_bits(data, b)
+    def _get_curr_variant_data(self, block=None):
+        """Gets the current variant's dosage or probabilities.
 
-        # Changing shape and computing dosage
-        probs.shape = (self._nb_samples, 2)
+        Args:
+            block (tuple): The variant's probability block (it is read from
+                           the file if it is not provided).
 
-        return probs / (2**b - 1), missing_data
+        """
+        if block is None:
+            block = self._read_curr_variant_block(reuse_buffer=True)
 
-    def _get_curr_variant_data(self):
-        """Gets the current variant's dosage or probabilities."""
-        if self._layout == 1:
-            # Getting the probabilities
-            probs = self._get_curr_variant_probs_layout_1()
+        return self._decode_block(block)
 
+    def _set_decoder(self):
+        """Sets the decoder of the probability blocks.
+
+        The layout and what to return are the same for all the variants of the
+        file, so the decoder is chosen once (when the file is opened) instead
+        of for every variant.
+
+        """
+        if self._layout == 1:
+            self._decode_block = self._decode_layout_1_dosage
             if self._return_probs:
-                # Returning the probabilities
-                return probs
+                self._decode_block = self._get_curr_variant_probs_layout_1
 
-            else:
-                # Returning the dosage
-                return self._layout_1_probs_to_dosage(probs)
+        elif self._return_probs:
+            self._decode_block = self._decode_layout_2_probs
+
+        elif HAS_KERNELS:
+            self._decode_block = self._decode_layout_2_dosage_kernel
 
         else:
-            # Getting the probabilities
-            probs, missing_data = self._get_curr_variant_probs_layout_2()
+            self._decode_block = self._decode_layout_2_dosage
 
-            if self._return_probs:
-                # Getting the alternative allele homozygous probabilities
-                last_probs = self._get_layout_2_last_probs(probs)
+    def _decode_layout_1_dosage(self, block):
+        """Decodes a probability block to dosage (layout 1)."""
+        return self._layout_1_probs_to_dosage(
+            self._get_curr_variant_probs_layout_1(block),
+        )
 
-                # Stacking the probabilities
-                last_probs.shape = (last_probs.shape[0], 1)
-                full_probs = np.hstack((probs, last_probs))
+    def _decode_layout_2_probs(self, block):
+        """Decodes a probability block to probabilities (layout 2)."""
+        return self._layout_2_raw_probs_to_probs(
+            *self._get_curr_variant_raw_probs_layout_2(block)
+        )
 
-                # Setting the missing to NaN
-                full_probs[missing_data] = np.nan
+    def _decode_layout_2_dosage(self, block):
+        """Decodes a probability block to dosage (layout 2)."""
+        # Computing the dosage directly from the raw probabilities
+        raw, b, missing_data = self._get_curr_variant_raw_probs_layout_2(block)
+        dosage = self._layout_2_raw_probs_to_dosage(raw, b)
 
-                # Returning the probabilities
-                return full_probs
+        # Setting the missing to NaN
+        dosage[missing_data] = np.nan
 
-            else:
-                # Computing the dosage
-                dosage = self._layout_2_probs_to_dosage(probs)
+        return dosage
 
-                # Setting the missing to NaN
-                dosage[missing_data] = np.nan
+    def _decode_layout_2_dosage_kernel(self, block):
+        """Decodes a probability block to dosage (layout 2, using a kernel)."""
+        # Computing the dosage directly from the raw probabilities
+        raw, b, missing_data = self._get_curr_variant_raw_probs_layout_2(block)
+        # (the missing are set to NaN by the kernel)
+        dosage = np.empty(self._nb_samples)
+        _layout_2_dosage_kernel(
+            raw, float(2**b - 1), self.prob_t, missing_data, dosage,
+        )
 
-                # Returning the dosage
-                return dosage
+        return dosage
 
     def _layout_1_probs_to_dosage(self, probs):
         """Transforms probability values to dosage (from layout 1)"""
         # Constructing the dosage
         dosage = 2 * probs[:, 2] + probs[:, 1]
         if self.prob_t > 0:
-            dosage[~np.any(probs >= self.prob_t, axis=1)] = np.nan
+            dosage[probs.max(axis=1) < self.prob_t] = np.nan
 
         return dosage
 
@@ -592,21 +1098,66 @@ class PyBGEN(object):
         """Gets the layout 2 last probabilities (homo alternative)."""
         return 1 - np.sum(probs, axis=1)
 
-    def _layout_2_probs_to_dosage(self, probs):
-        """Transforms probability values to dosage (from layout 2)."""
-        # Computing the last genotype's probabilities
+    def _layout_2_raw_probs_to_probs(self, raw, b, missing_data):
+        """Transforms raw probability values to probabilities (layout 2)."""
+        # Changing shape and scaling
+        probs = raw.reshape(self._nb_samples, 2) * self._get_probs_scale(b)
+
+        # Getting the alternative allele homozygous probabilities
         last_probs = self._get_layout_2_last_probs(probs)
 
+        # Stacking the probabilities
+        last_probs.shape = (last_probs.shape[0], 1)
+        full_probs = np.hstack((probs, last_probs))
+
+        # Setting the missing to NaN
+        full_probs[missing_data] = np.nan
+
+        return full_probs
+
+    def _get_probs_scale(self, b):
+        """Gets the scale of the raw probabilities (layout 2).
+
+        Args:
+            b (int): The number of bits used to encode the probabilities.
+
+        Returns:
+            float: The reciprocal of ``2**b - 1`` (computed once per number of
+            bits), so that the probabilities are multiplied instead of
+            divided.
+
+        """
+        scale = self._probs_scales.get(b)
+        if scale is None:
+            scale = self._probs_scales[b] = 1 / (2**b - 1)
+
+        return scale
+
+    def _layout_2_raw_probs_to_dosage(self, raw, b):
+        """Transforms raw probability values to dosage (from layout 2).
+
+        The two probabilities of the samples are scaled from strided views of
+        the raw values, so the probability matrix is never built. They are
+        computed in double precision, exactly like the kernels, so that the
+        dosage doesn't depend on the decoder being used.
+
+        """
+        max_value = float(2**b - 1)
+
+        # The probabilities of the three genotypes
+        p_aa = raw[0::2] / max_value
+        p_ab = raw[1::2] / max_value
+        p_bb = 1 - (p_aa + p_ab)
+
         # Constructing the dosage
-        dosage = 2 * last_probs + probs[:, 1]
+        dosage = 2 * p_bb + p_ab
 
-        # Setting low quality to NaN
+        # Setting low quality to NaN (the best probability is compared to the
+        # threshold, instead of comparing all of them)
         if self.prob_t > 0:
-            good_probs = (
-                np.any(probs >= self.prob_t, axis=1) |
-                (last_probs >= self.prob_t)
-            )
-            dosage[~good_probs] = np.nan
+            best_probs = np.maximum(p_aa, p_ab)
+            np.maximum(best_probs, p_bb, out=best_probs)
+            dosage[best_probs < self.prob_t] = np.nan
 
         return dosage
 
@@ -622,21 +1173,21 @@ class PyBGEN(object):
     def _parse_header_block(self):
         """Parses the header block."""
         # Getting the data offset (the start point of the data
-        self._offset = unpack("<I", self._bgen.read(4))[0]
+        self._offset = _UINT32.unpack(self._bgen.read(4))[0]
         self._first_variant_block = self._offset + 4
 
         # Getting the header size
-        self._header_size = unpack("<I", self._bgen.read(4))[0]
+        self._header_size = _UINT32.unpack(self._bgen.read(4))[0]
 
         # Getting the number of samples and variants
-        self._nb_variants = unpack("<I", self._bgen.read(4))[0]
-        self._nb_samples = unpack("<I", self._bgen.read(4))[0]
+        self._nb_variants = _UINT32.unpack(self._bgen.read(4))[0]
+        self._nb_samples = _UINT32.unpack(self._bgen.read(4))[0]
 
         # Checking the magic number
         magic = self._bgen.read(4)
         if magic != b"bgen":
             # The magic number might be 0, then
-            if unpack("<I", magic)[0] != 0:
+            if _UINT32.unpack(magic)[0] != 0:
                 raise ValueError(
                     "{}: invalid BGEN file.".format(self._bgen.name)
                 )
@@ -645,31 +1196,34 @@ class PyBGEN(object):
         self._bgen.read(self._header_size - 20)
 
         # Reading the flag
-        flag = np.frombuffer(self._bgen.read(4), dtype=np.uint8)
-        flag = np.unpackbits(flag.reshape(1, flag.shape[0]).T, axis=1)
+        flag = _UINT32.unpack(self._bgen.read(4))[0]
 
-        # Getting the compression type from the layout
-        compression = _bits_to_int(flag[0, -2:])
+        # Getting the compression type (bits 0 and 1)
+        compression = flag & 0x3
         self._is_compressed = False
         if compression == 0:
             # No decompression required
             self._decompress = self._no_decompress
 
         elif compression == 1:
-            # ZLIB decompression
-            self._decompress = zlib.decompress
+            # ZLIB decompression (using ISA-L, which is faster, if available)
+            self._decompress = self._zlib_decompress
+            if HAS_ISAL:
+                self._decompress = self._isal_decompress
             self._is_compressed = True
 
         elif compression == 2:
             if not HAS_ZSTD:
                 raise ValueError("zstandard module is not installed")
 
-            # ZSTANDARD decompression (needs to be check)
-            self._decompress = zstd.ZstdDecompressor().decompress
+            # ZSTANDARD decompression (the same decompression context is
+            # reused for all the variants)
+            self._zstd_decompressor = zstd.ZstdDecompressor()
+            self._decompress = self._zstd_decompress
             self._is_compressed = True
 
-        # Getting the layout
-        layout = _bits_to_int(flag[0, -6:-2])
+        # Getting the layout (bits 2 to 5)
+        layout = (flag >> 2) & 0xF
         if layout == 0:
             raise ValueError(
                 "{}: invalid BGEN file".format(self._bgen.name)
@@ -683,20 +1237,20 @@ class PyBGEN(object):
                 "{}: {} invalid layout type".format(self._bgen.name, layout)
             )
 
-        # Checking if samples are in the file
-        self._has_sample = flag[-1, 0] == 1
+        # Checking if samples are in the file (bit 31)
+        self._has_sample = (flag >> 31) & 1 == 1
 
     def _parse_sample_block(self):
         """Parses the sample block."""
         # Getting the block size
-        block_size = unpack("<I", self._bgen.read(4))[0]
+        block_size = _UINT32.unpack(self._bgen.read(4))[0]
         if block_size + self._header_size > self._offset:
             raise ValueError(
                 "{}: invalid BGEN file".format(self._bgen.name)
             )
 
         # Checking the number of samples
-        n = unpack("<I", self._bgen.read(4))[0]
+        n = _UINT32.unpack(self._bgen.read(4))[0]
         if n != self._nb_samples:
             raise ValueError(
                 "{}: invalid BGEN file".format(self._bgen.name)
@@ -705,7 +1259,7 @@ class PyBGEN(object):
         # Getting the sample information
         samples = []
         for i in range(self._nb_samples):
-            size = unpack("<H", self._bgen.read(2))[0]
+            size = _UINT16.unpack(self._bgen.read(2))[0]
             samples.append(self._bgen.read(size).decode())
         self._samples = tuple(samples)
 
@@ -714,11 +1268,25 @@ class PyBGEN(object):
             raise ValueError("{}: number of samples different between header "
                              "and sample block".format(self._bgen.name))
 
-    def _connect_index(self):
+    def _connect_index(self, create_indexes=True):
         """Connect to the index (which is an SQLITE database)."""
-        self._bgen_db = sqlite3.connect(self._bgen.name + ".bgi")
+        # The compiled statements are cached (there is one statement for each
+        # number of names fetched at once)
+        self._bgen_db = sqlite3.connect(
+            self._bgen.name + ".bgi", cached_statements=_SQL_CACHED_STATEMENTS,
+        )
         self._bgen_index = self._bgen_db.cursor()
 
+        # A larger page cache (64 MiB) and memory mapping (256 MiB) for
+        # repeated lookups, and the temporary table of names kept in memory
+        self._bgen_index.execute("PRAGMA cache_size = -65536")
+        self._bgen_index.execute("PRAGMA mmap_size = 268435456")
+        self._bgen_index.execute("PRAGMA temp_store = MEMORY")
+
+        # Creating the missing SQL indexes
+        if create_indexes:
+            self._create_sql_indexes()
+
         # Fetching the number of variants and the first and last seek position
         self._bgen_index.execute(
             "SELECT COUNT (rsid), "
@@ -744,39 +1312,136 @@ class PyBGEN(object):
         if first_variant_block != self._first_variant_block:
             raise ValueError("{}: invalid index".format(self._bgen.name))
 
+    def _create_sql_indexes(self):
+        """Creates the SQL indexes missing from the index file.
+
+        The index file doesn't need to have an index on the names or on the
+        positions (bgenix creates a primary key starting with the chromosome
+        and the position, but none for the names), so the lookups might need
+        to scan the whole table. The indexes are only created if no existing
+        index starts with the same columns.
+
+        """
+        # The columns of the existing indexes
+        self._bgen_index.execute("PRAGMA index_list(Variant)")
+        existing = []
+        for index in [row[1] for row in self._bgen_index.fetchall()]:
+            self._bgen_index.execute('PRAGMA index_info("{}")'.format(index))
+            existing.append(tuple(
+                row[2] for row in sorted(self._bgen_index.fetchall())
+            ))
+
+        for name, nb_searched, columns in _SQL_INDEXES:
+            searched = columns[:nb_searched]
+            if any(index[:nb_searched] == searched for index in existing):
+                continue
+
+            # The index file might be read only
+            try:
+                self._bgen_index.execute(
+                    "CREATE INDEX IF NOT EXISTS {} ON Variant ({})".format(
+                        name, ", ".join(columns),
+                    )
+                )
+                self._bgen_db.commit()
+
+            except sqlite3.OperationalError as e:
+                logger.info("%s: unable to create index '%s' (%s)",
+                            self._bgen.name + ".bgi", name, e)
+
     @staticmethod
-    def _no_decompress(data):
+    def _no_decompress(data, size):
         return data
 
+    @staticmethod
+    def _zlib_decompress(data, size):
+        """Decompresses zlib data (allocating the final size at once)."""
+        return zlib.decompress(data, zlib.MAX_WBITS, size)
+
+    @staticmethod
+    def _isal_decompress(data, size):
+        """Decompresses zlib data using ISA-L."""
+        return isal_zlib.decompress(data, isal_zlib.MAX_WBITS, size)
+
+    def _zstd_decompress(self, data, size):
+        """Decompresses zstandard data.
+
+        The size is only used when it is not written in the zstandard frame.
+
+        """
+        return self._zstd_decompressor.decompress(data, max_output_size=size)
+
+
+class _PipelineError:
+    """An exception raised by a pipeline's stage (sent to the next stage)."""
+    __slots__ = ("exception", )
+
+    def __init__(self, exception):
+        self.exception = exception
 
-def _bits_to_int(bits):
-    """Converts bits to int."""
-    result = 0
-    for bit in bits:
-        result = (result << 1) | bit
-    return result
 
+# The end of a pipeline's stage
+_END_OF_STAGE = object()
+
+
+def _pipeline_stage(items, output, stop, func=None):
+    """Runs a stage of a pipeline (in its own thread).
+
+    Args:
+        items (iterable): The items of the stage.
+        output (queue.Queue): The queue of the next stage.
+        stop (threading.Event): The event set when the iteration is stopped.
+        func (function): The function applied to the items (optional).
+
+    The stage ends by sending ``_END_OF_STAGE``. An exception raised by the
+    stage (or received from the previous one) is sent to the next stage.
+
+    """
+    try:
+        for item in items:
+            if func is not None and not isinstance(item, _PipelineError):
+                item = func(item)
+            if not _put_pipeline_item(output, item, stop):
+                return
+
+    except Exception as exception:
+        if not _put_pipeline_item(output, _PipelineError(exception), stop):
+            return
+
+    _put_pipeline_item(output, _END_OF_STAGE, stop)
+
+
+def _put_pipeline_item(output, item, stop):
+    """Puts an item in a queue (returns False if the iteration is stopped)."""
+    while not stop.is_set():
+        try:
+            output.put(item, timeout=_PIPELINE_TIMEOUT)
+            return True
+        except queue.Full:
+            pass
 
-def _byte_to_int_python3(byte):
-    """Converts a byte to a int for python 3."""
-    return byte
+    return False
 
 
-def _byte_to_int_python2(byte):
-    """Converts a byte to a int for python 2."""
-    return unpack("<B", byte)[0]
+def _iter_pipeline_queue(items, stop):
+    """Iterates over a stage's queue (until its end or the stop)."""
+    while not stop.is_set():
+        try:
+            item = items.get(timeout=_PIPELINE_TIMEOUT)
+        except queue.Empty:
+            continue
 
+        if item is _END_OF_STAGE:
+            return
 
-_byte_to_int = _byte_to_int_python3
-if PYTHON_VERSION < 3:
-    _byte_to_int = _byte_to_int_python2
+        yield item
 
 
 def _pack_bits(data, b):
     """Unpacks BGEN probabilities (as bits)."""
     # Getting the data from the bytes
     data = np.fromiter(
-        ((_byte_to_int(byte) >> i) & 1 for byte in data for i in range(8)),
+        ((byte >> i) & 1 for byte in data for i in range(8)),
         dtype=bool,
     )
     data.shape = (data.shape[0] // b, b)
@@ -24,6 +24,7 @@
 
 
 import unittest
+from multiprocessing.pool import ThreadPool
 
 from .test_pybgen import reader_tests
 from .test_parallel import parallel_reader_tests
@@ -44,3 +45,72 @@ for test_case in parallel_reader_tests:
     test_suite.addTests(
         unittest.TestLoader().loadTestsFromTestCase(test_case),
     )
+
+
+def _run_test_case(test_case):
+    """Runs all the tests of a test case (in its own result)."""
+    result = unittest.TestResult()
+    unittest.TestLoader().loadTestsFromTestCase(test_case).run(result)
+    return result
+
+
+class _ConcurrentSuite:
+    """Runs test cases concurrently (using threads).
+
+    Args:
+        test_cases (list): The test cases to run.
+        jobs (int): The number of test cases to run at the same time.
+
+    Each test case is run in its own result (so that its class fixtures are
+    kept to itself), which is merged in the final one afterwards.
+
+    """
+    def __init__(self, test_cases, jobs):
+        self.test_cases = test_cases
+        self.jobs = jobs
+
+    def __call__(self, result):
+        pool = ThreadPool(self.jobs)
+        try:
+            case_results = pool.map(_run_test_case, self.test_cases)
+        finally:
+            pool.close()
+            pool.join()
+
+        for case_result in case_results:
+            result.testsRun += case_result.testsRun
+            result.failures.extend(case_result.failures)
+            result.errors.extend(case_result.errors)
+            result.skipped.extend(case_result.skipped)
+            result.expectedFailures.extend(case_result.expectedFailures)
+            result.unexpectedSuccesses.extend(
+                case_result.unexpectedSuccesses,
+            )
+
+        return result
+
+
+def get_test_suite(jobs=1):
+    """Gets the test suite.
+
+    Args:
+        jobs (int): The number of test cases to run at the same time.
+
+    Returns:
+        unittest.TestSuite: The test suite.
+
+    Only the reader's test cases are run concurrently. The parallel reader's
+    ones start processes (which shouldn't be forked while other threads are
+    running), so they are run afterwards, one at a time.
+
+    """
+    if jobs <= 1:
+        return test_suite
+
+    suite = unittest.TestSuite()
+    suite.addTest(_ConcurrentSuite(reader_tests, jobs))
+    for test_case in parallel_reader_tests:
+        suite.addTests(
+            unittest.TestLoader().loadTestsFromTestCase(test_case),
+        )
+    return suite
@@ -25,10 +25,24 @@
 
 
 import sys
+import argparse
 import unittest
 
-from . import test_suite
+from . import get_test_suite
+from .truths import read_all_truths
 
 
-result = unittest.TextTestRunner(verbosity=1).run(test_suite)
+parser = argparse.ArgumentParser(prog="python -m pybgen.tests")
+parser.add_argument(
+    "-j", "--jobs", type=int, default=1, metavar="N",
+    help="The number of test cases to run at the same time. [%(default)d]",
+)
+args = parser.parse_args()
+
+# The truths are read beforehand when running concurrently (so that the
+# files are read in parallel, and not while the tests' threads are running)
+if args.jobs > 1:
+    read_all_truths(args.jobs)
+
+result = unittest.TextTestRunner(verbosity=1).run(get_test_suite(args.jobs))
 sys.exit(not result.wasSuccessful())
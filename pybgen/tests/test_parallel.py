@@ -24,133 +24,477 @@
 
 
 import os
-import random
+import shutil
+import sqlite3
 import unittest
-
-from pkg_resources import resource_filename
+import multiprocessing
+from itertools import chain
+from tempfile import mkdtemp
+from contextlib import closing
 
 import numpy as np
 
+from ..pybgen import PyBGEN
 from ..parallel import ParallelPyBGEN
-from ..pybgen import HAS_ZSTD
-from .truths import truths
-from .test_pybgen import ReaderTests
+from .truths import truths, get_test_filename
+from .test_pybgen import ReaderTests, make_test_cases
 
 
 __all__ = ["parallel_reader_tests"]
 
 
+def _get_pinned_cores(bgen_fn, cpus, conn):
+    """Sends the cores of pinned workers (from a child process)."""
+    bgen = ParallelPyBGEN(bgen_fn, cpus=cpus, pin_workers=True,
+                          create_indexes=False)
+    try:
+        list(bgen.iter_variants())
+        conn.send([os.sched_getaffinity(worker.pid)
+                   for worker in bgen._pool._pool])
+    finally:
+        bgen.close()
+        conn.close()
+
+
 class ParallelReaderTests(ReaderTests):
 
-    def setUp(self):
-        # Getting the truth for this file
-        self.truths = truths["dosage"][self.truth_filename]
+    @classmethod
+    def _open_bgen(cls, bgen_fn):
+        """Opens the BGEN file shared by the tests."""
+        return ParallelPyBGEN(bgen_fn, create_indexes=False)
+
+    def test_interleaved_iterations(self):
+        """Tests an iteration stopped early doesn't stop the other ones."""
+        for stopped in range(2):
+            iterators = [self.bgen.iter_variants() for _ in range(2)]
+            first_variants = [next(iterator) for iterator in iterators]
+
+            iterators[stopped].close()
 
-        # Reading the BGEN file
-        bgen_fn = resource_filename(__name__, self.bgen_filename)
-        self.bgen = ParallelPyBGEN(bgen_fn)
+            # The remaining iteration still gets all its variants
+            remaining = 1 - stopped
+            names = self._compare_iterated_variants(
+                chain(first_variants[remaining:remaining+1],
+                      iterators[remaining]),
+            )
+            self.assertEqual(names, self.truths["variant_set"])
 
 
 class ParallelProbsReaderTests(ParallelReaderTests):
 
-    def setUp(self):
-        # Getting the truth for this file
-        self.truths = truths["probs"][self.truth_filename]
+    truth_kind = "probs"
 
-        # Reading the BGEN file
-        bgen_fn = resource_filename(__name__, self.bgen_filename)
-        self.bgen = ParallelPyBGEN(bgen_fn, probs_only=True)
+    @classmethod
+    def _open_bgen(cls, bgen_fn):
+        """Opens the BGEN file shared by the tests."""
+        return ParallelPyBGEN(bgen_fn, probs_only=True, create_indexes=False)
 
     def test_check_returned_value(self):
         """Tests the module is returning probability data."""
         self.assertTrue(self.bgen._return_probs)
 
+    def test_quantized_probs(self):
+        """Tests the raw probabilities are sent for layout 2 files."""
+        self.assertEqual(self.bgen._quantized, self.bgen._layout == 2)
 
-class Test32bits(ParallelReaderTests):
-    bgen_filename = os.path.join("data", "example.32bits.bgen")
-    truth_filename = "example.32bits.truths.txt.bz2"
 
+class ParallelThreadsReaderTests(ParallelReaderTests):
 
-class Test32bitsProbs(ParallelProbsReaderTests):
-    bgen_filename = os.path.join("data", "example.32bits.bgen")
-    truth_filename = "example.32bits.probs.truths.txt.bz2"
+    @classmethod
+    def _open_bgen(cls, bgen_fn):
+        """Opens the BGEN file shared by the tests."""
+        return ParallelPyBGEN(bgen_fn, threads=True, create_indexes=False)
 
+    def test_early_stop(self):
+        """Tests stopping the iteration before the end."""
+        iterator = self.bgen.iter_variants()
+        for _ in zip(range(5), iterator):
+            pass
+        iterator.close()
 
-class Test24bits(ParallelReaderTests):
-    bgen_filename = os.path.join("data", "example.24bits.bgen")
-    truth_filename = "example.24bits.truths.txt.bz2"
+        # The pool should have been stopped
+        self.assertTrue(self.bgen._pool is None)
 
+    def test_early_stop_other_iteration(self):
+        """Tests stopping an iteration while another one is running."""
+        iterators = [self.bgen.iter_variants() for _ in range(2)]
+        for iterator in iterators:
+            next(iterator)
+        pool = self.bgen._pool
 
-class Test24bitsProbs(ParallelProbsReaderTests):
-    bgen_filename = os.path.join("data", "example.24bits.bgen")
-    truth_filename = "example.24bits.probs.truths.txt.bz2"
+        # The pool is kept for the other iteration
+        iterators[0].close()
+        self.assertTrue(self.bgen._pool is pool)
 
+        # The pool is stopped with the last iteration
+        iterators[1].close()
+        self.assertTrue(self.bgen._pool is None)
 
-class Test16bits(ParallelReaderTests):
-    bgen_filename = os.path.join("data", "example.16bits.bgen")
-    truth_filename = "example.16bits.truths.txt.bz2"
+    def test_pool_closed(self):
+        """Tests the workers exit cleanly when closing."""
+        # The shared file can't be closed
+        bgen = self._open_bgen(get_test_filename(self.bgen_filename))
+        list(bgen.iter_variants())
+        workers = list(bgen._pool._pool)
 
+        bgen.close()
+        self.assertTrue(bgen._pool is None)
+        for worker in workers:
+            self.assertFalse(worker.is_alive())
 
-class Test16bitsProbs(ParallelProbsReaderTests):
-    bgen_filename = os.path.join("data", "example.16bits.bgen")
-    truth_filename = "example.16bits.probs.truths.txt.bz2"
+    def test_pool_reused(self):
+        """Tests the pool is reused between iterations."""
+        list(self.bgen.iter_variants())
+        pool = self.bgen._pool
+        self.assertTrue(pool is not None)
 
+        list(self.bgen.iter_variants())
+        self.assertTrue(self.bgen._pool is pool)
 
-@unittest.skipIf(not HAS_ZSTD, "module 'zstandard' not installed")
-class Test16bitsZstd(ParallelReaderTests):
-    bgen_filename = os.path.join("data", "example.16bits.zstd.bgen")
-    truth_filename = "example.16bits.zstd.truths.txt.bz2"
 
+class ParallelThreadsProbsReaderTests(ParallelThreadsReaderTests):
 
-@unittest.skipIf(not HAS_ZSTD, "module 'zstandard' not installed")
-class Test16bitsZstdProbs(ParallelProbsReaderTests):
-    bgen_filename = os.path.join("data", "example.16bits.zstd.bgen")
-    truth_filename = "example.16bits.zstd.probs.truths.txt.bz2"
+    truth_kind = "probs"
 
+    @classmethod
+    def _open_bgen(cls, bgen_fn):
+        """Opens the BGEN file shared by the tests."""
+        return ParallelPyBGEN(bgen_fn, probs_only=True, threads=True,
+                              create_indexes=False)
 
-class Test9bits(ParallelReaderTests):
-    bgen_filename = os.path.join("data", "example.9bits.bgen")
-    truth_filename = "example.9bits.truths.txt.bz2"
+    def test_check_returned_value(self):
+        """Tests the module is returning probability data."""
+        self.assertTrue(self.bgen._return_probs)
 
 
-class Test9bitsProbs(ParallelProbsReaderTests):
-    bgen_filename = os.path.join("data", "example.9bits.bgen")
-    truth_filename = "example.9bits.probs.truths.txt.bz2"
+class ParallelDecodeThreadsReaderTests(ParallelReaderTests):
 
+    @classmethod
+    def _open_bgen(cls, bgen_fn):
+        """Opens the BGEN file shared by the tests."""
+        return ParallelPyBGEN(bgen_fn, decode_threads=2, create_indexes=False)
 
-class Test8bits(ParallelReaderTests):
-    bgen_filename = os.path.join("data", "example.8bits.bgen")
-    truth_filename = "example.8bits.truths.txt.bz2"
+    def test_pool_closed(self):
+        """Tests the workers (and their decoders) exit when closing."""
+        # The shared file can't be closed
+        bgen = self._open_bgen(get_test_filename(self.bgen_filename))
+        list(bgen.iter_variants())
+        workers = list(bgen._pool._pool)
 
+        bgen.close()
+        for worker in workers:
+            worker.join(5)
+            self.assertFalse(worker.is_alive())
 
-class Test8bitsProbs(ParallelProbsReaderTests):
-    bgen_filename = os.path.join("data", "example.8bits.bgen")
-    truth_filename = "example.8bits.probs.truths.txt.bz2"
 
+class ParallelDecodeThreadsProbsReaderTests(ParallelDecodeThreadsReaderTests):
 
-class Test3bits(ParallelReaderTests):
-    bgen_filename = os.path.join("data", "example.3bits.bgen")
-    truth_filename = "example.3bits.truths.txt.bz2"
+    truth_kind = "probs"
 
+    @classmethod
+    def _open_bgen(cls, bgen_fn):
+        """Opens the BGEN file shared by the tests."""
+        return ParallelPyBGEN(bgen_fn, probs_only=True, decode_threads=2,
+                              create_indexes=False)
 
-class Test3bitsProbs(ParallelProbsReaderTests):
-    bgen_filename = os.path.join("data", "example.3bits.bgen")
-    truth_filename = "example.3bits.probs.truths.txt.bz2"
+    def test_check_returned_value(self):
+        """Tests the module is returning probability data."""
+        self.assertTrue(self.bgen._return_probs)
+
+
+@unittest.skipIf(not hasattr(os, "sched_setaffinity"), "Linux only")
+class ParallelPinnedReaderTests(ParallelReaderTests):
+
+    @classmethod
+    def _open_bgen(cls, bgen_fn):
+        """Opens the BGEN file shared by the tests."""
+        return ParallelPyBGEN(bgen_fn, pin_workers=True, create_indexes=False)
+
+    def test_workers_pinned(self):
+        """Tests the workers are pinned to a single core."""
+        list(self.bgen.iter_variants())
+
+        cores = set()
+        for worker in self.bgen._pool._pool:
+            affinity = os.sched_getaffinity(worker.pid)
+            self.assertEqual(1, len(affinity))
+            cores |= affinity
+
+        # The workers are on distinct cores (when there are enough of them)
+        available_cores = os.sched_getaffinity(0)
+        self.assertTrue(cores <= available_cores)
+        self.assertEqual(min(self.bgen.cpus, len(available_cores)), len(cores))
+
+    @unittest.skipIf(len(os.sched_getaffinity(0)) < 2, "requires two cores")
+    def test_workers_pinned_nested(self):
+        """Tests the workers of a pool created in a child process."""
+        cpus = min(4, len(os.sched_getaffinity(0)))
+
+        # The pool is created by a child process (so that the workers'
+        # process identities share the child's one)
+        parent_conn, child_conn = multiprocessing.Pipe(duplex=False)
+        child = multiprocessing.Process(
+            target=_get_pinned_cores,
+            args=(self.bgen._bgen.name, cpus, child_conn),
+        )
+        child.start()
+        child_conn.close()
+        affinities = parent_conn.recv()
+        child.join()
+        self.assertEqual(0, child.exitcode)
+
+        # Each worker is on its own core
+        self.assertEqual(cpus, len(affinities))
+        for affinity in affinities:
+            self.assertEqual(1, len(affinity))
+        self.assertEqual(cpus, len(set.union(*affinities)))
+
+
+class ParallelCacheReaderTests(ParallelReaderTests):
+
+    @classmethod
+    def _open_bgen(cls, bgen_fn):
+        """Opens the BGEN file shared by the tests."""
+        return ParallelPyBGEN(bgen_fn, cache_size=10, create_indexes=False)
+
+    def test_cached_variants(self):
+        """Tests variants read again come from the cache."""
+        # The cache is shared with the other tests
+        self.bgen._cache.clear()
+
+        # Fetching random variants in the index
+        # (sampled by SQLite, so that only the sampled rows are fetched)
+        self.bgen._bgen_index.execute(
+            "SELECT rsid FROM Variant ORDER BY RANDOM() LIMIT 5"
+        )
+        names = [_[0] for _ in self.bgen._bgen_index.fetchall()]
+
+        # Reading them a first time (modifying the returned data)
+        for variant, dosage in self.bgen.iter_variants_by_names(names):
+            dosage[:] = -1
+        self.assertEqual(5, len(self.bgen._cache))
+
+        # Reading them a second time (the cache shouldn't be modified)
+        self.bgen._terminate_pool()
+        seen_variants = set()
+        for variant, dosage in self.bgen.iter_variants_by_names(names):
+            seen_variants.add(variant.name)
+            self._assert_close(self._get_truth_data(variant.name), dosage)
+        self.assertEqual(seen_variants, set(names))
+
+        # No worker should have been required
+        self.assertTrue(self.bgen._pool is None)
+
+    def test_cached_variants_order(self):
+        """Tests the cached variants are returned at their position."""
+        # The cache is shared with the other tests
+        self.bgen._cache.clear()
+
+        self.bgen._bgen_index.execute(
+            "SELECT rsid FROM Variant ORDER BY file_start_position LIMIT 20"
+        )
+        names = [_[0] for _ in self.bgen._bgen_index.fetchall()]
+
+        # The first time, only the last variants are kept in the cache
+        expected = [
+            variant.name
+            for variant, _ in self.bgen.iter_variants_by_names(names)
+        ]
+        self.assertEqual(10, len(self.bgen._cache))
+
+        # The second time, the cached variants keep their position
+        observed = [
+            variant.name
+            for variant, _ in self.bgen.iter_variants_by_names(names)
+        ]
+        self.assertEqual(expected, observed)
+
+    def test_cache_size(self):
+        """Tests the cache doesn't grow over its maximal size."""
+        list(self.bgen.iter_variants())
+        self.assertEqual(10, len(self.bgen._cache))
+
+
+class ParallelSharedMemoryReaderTests(ParallelReaderTests):
+
+    @classmethod
+    def _open_bgen(cls, bgen_fn):
+        """Opens the BGEN file shared by the tests."""
+        return ParallelPyBGEN(bgen_fn, use_shared_memory=True,
+                              create_indexes=False)
+
+    def test_shared_memory_released(self):
+        """Tests the shared memory is released when closing."""
+        # The shared file can't be closed
+        bgen = self._open_bgen(get_test_filename(self.bgen_filename))
+        self.assertTrue(bgen._shm is not None)
+        bgen.close()
+        self.assertTrue(bgen._shm is None)
+
+    def test_slots_reused(self):
+        """Tests the iteration when the shared memory slots are reused."""
+        bgen_fn = get_test_filename(self.bgen_filename)
+        with ParallelPyBGEN(bgen_fn, probs_only=self.bgen._return_probs,
+                            use_shared_memory=True, batch_size=4,
+                            prefetch_depth=2, create_indexes=False) as bgen:
+            self.assertEqual(12, bgen._nb_slots)
+
+            seen_variants = set()
+            for variant, data in bgen.iter_variants():
+                seen_variants.add(variant.name)
+                self._assert_close(self._get_truth_data(variant.name), data)
+            self.assertEqual(seen_variants, self.truths["variant_set"])
+
+
+class ParallelSharedMemoryProbsReaderTests(ParallelSharedMemoryReaderTests):
+
+    truth_kind = "probs"
+
+    @classmethod
+    def _open_bgen(cls, bgen_fn):
+        """Opens the BGEN file shared by the tests."""
+        return ParallelPyBGEN(bgen_fn, probs_only=True,
+                              use_shared_memory=True, create_indexes=False)
+
+    def test_check_returned_value(self):
+        """Tests the module is returning probability data."""
+        self.assertTrue(self.bgen._return_probs)
 
 
-class TestLayout1(ParallelReaderTests):
-    bgen_filename = os.path.join("data", "cohort1.bgen")
-    truth_filename = "cohort1.truths.txt.bz2"
+class TestSeeksCache(unittest.TestCase):
 
+    def setUp(self):
+        # Copying the BGEN file (and its index) in a temporary directory
+        self.tmp_dir = mkdtemp(prefix="pybgen_test_")
+        self.bgen_fn = os.path.join(self.tmp_dir, "example.bgen")
+        original_fn = get_test_filename(
+            os.path.join("data", "example.16bits.bgen"),
+        )
+        shutil.copyfile(original_fn, self.bgen_fn)
+        shutil.copyfile(original_fn + ".bgi", self.bgen_fn + ".bgi")
+
+        self.truths = truths["dosage"]["example.16bits.truths.txt.bz2"]
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _iter_all_variants(self):
+        """Iterates over all the variants using the seeks cache."""
+        seen_variants = set()
+        with ParallelPyBGEN(self.bgen_fn, cache_seeks=True) as bgen:
+            for variant, dosage in bgen.iter_variants():
+                seen_variants.add(variant.name)
+                np.testing.assert_array_almost_equal(
+                    self.truths["data"][self.truths["index"][variant.name]],
+                    dosage,
+                )
+            seeks = bgen._seeks
+
+        self.assertEqual(seen_variants, self.truths["variant_set"])
+        return seeks
+
+    def test_seeks_cache(self):
+        """Tests the seeks are saved and then reused."""
+        seeks_fn = self.bgen_fn + ".seeks.npy"
+
+        # The first time, the seeks are saved
+        seeks = self._iter_all_variants()
+        self.assertFalse(isinstance(seeks, np.memmap))
+        self.assertTrue(os.path.isfile(seeks_fn))
+
+        # The second time, they are loaded from the file
+        cached_seeks = self._iter_all_variants()
+        self.assertTrue(isinstance(cached_seeks, np.memmap))
+        np.testing.assert_array_equal(seeks, cached_seeks)
+
+    def test_outdated_seeks_cache(self):
+        """Tests the seeks are not loaded if the index is more recent."""
+        seeks_fn = self.bgen_fn + ".seeks.npy"
+
+        self._iter_all_variants()
+        mtime = os.path.getmtime(seeks_fn)
+        os.utime(self.bgen_fn + ".bgi", (mtime + 10, mtime + 10))
+
+        self.assertFalse(isinstance(self._iter_all_variants(), np.memmap))
+
+
+class TestRegionVariantInfo(unittest.TestCase):
 
-class TestLayout1Probs(ParallelProbsReaderTests):
-    bgen_filename = os.path.join("data", "cohort1.bgen")
-    truth_filename = "cohort1.probs.truths.txt.bz2"
+    def setUp(self):
+        # Copying the BGEN file (and its index) in a temporary directory
+        self.tmp_dir = mkdtemp(prefix="pybgen_test_")
+        self.bgen_fn = os.path.join(self.tmp_dir, "example.bgen")
+        original_fn = get_test_filename(
+            os.path.join("data", "example.16bits.bgen"),
+        )
+        shutil.copyfile(original_fn, self.bgen_fn)
+        shutil.copyfile(original_fn + ".bgi", self.bgen_fn + ".bgi")
+
+        # The names in the index are different from the ones in the file
+        with closing(sqlite3.connect(self.bgen_fn + ".bgi")) as db:
+            db.execute("UPDATE Variant SET rsid = 'INDEX_' || rsid")
+            db.commit()
+
+        self.truths = truths["dosage"]["example.16bits.truths.txt.bz2"]
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    @staticmethod
+    def _get_region(bgen, chrom, start, end):
+        """Gets the variants of a region (and their data)."""
+        variants = []
+        data = []
+        for variant, values in bgen.iter_variants_in_region(chrom, start,
+                                                            end):
+            variants.append((variant.name, variant.chrom, variant.pos,
+                             variant.a1, variant.a2))
+            data.append(np.array(values))
+
+        return variants, np.array(data)
+
+    def test_same_region(self):
+        """Tests both readers take the region's information from the index."""
+        variant_info = self.truths["variant_info"]
+        chrom = variant_info["chrom"][0]
+        start, end = (
+            int(pos) for pos in np.percentile(variant_info["pos"], [25, 75])
+        )
+
+        with PyBGEN(self.bgen_fn) as bgen:
+            expected, expected_data = self._get_region(bgen, chrom, start,
+                                                       end)
+        self.assertTrue(len(expected) > 0)
+        for name, *_ in expected:
+            self.assertTrue(name.startswith("INDEX_"))
+
+        for threads in (False, True):
+            with ParallelPyBGEN(self.bgen_fn, threads=threads) as bgen:
+                observed, observed_data = self._get_region(bgen, chrom, start,
+                                                           end)
+            self.assertEqual(expected, observed)
+            np.testing.assert_array_equal(expected_data, observed_data)
 
 
 parallel_reader_tests = (
-    Test32bits, Test24bits, Test16bits, Test16bitsZstd, Test9bits, Test8bits,
-    Test3bits, TestLayout1, Test32bitsProbs, Test24bitsProbs, Test16bitsProbs,
-    Test16bitsZstdProbs, Test9bitsProbs, Test8bitsProbs, Test3bitsProbs,
-    TestLayout1Probs,
+    make_test_cases(globals(), ParallelReaderTests) +
+    make_test_cases(globals(), ParallelProbsReaderTests, suffix="Probs") +
+    make_test_cases(globals(), ParallelThreadsReaderTests,
+                    ("16bits", "16bitsZstd", "Layout1"), suffix="Threads") +
+    make_test_cases(globals(), ParallelThreadsProbsReaderTests, ("16bits", ),
+                    suffix="ThreadsProbs") +
+    make_test_cases(globals(), ParallelCacheReaderTests,
+                    ("16bits", "Layout1"), suffix="Cache") +
+    make_test_cases(globals(), ParallelSharedMemoryReaderTests,
+                    ("16bits", "Layout1"), suffix="SharedMemory") +
+    make_test_cases(globals(), ParallelSharedMemoryProbsReaderTests,
+                    ("16bits", ), suffix="SharedMemoryProbs") +
+    (TestSeeksCache, TestRegionVariantInfo) +
+    make_test_cases(globals(), ParallelDecodeThreadsReaderTests,
+                    ("16bits", "16bitsZstd", "Layout1"),
+                    suffix="DecodeThreads") +
+    make_test_cases(globals(), ParallelDecodeThreadsProbsReaderTests,
+                    ("16bits", ), suffix="DecodeThreadsProbs") +
+    make_test_cases(globals(), ParallelPinnedReaderTests, ("16bits", ),
+                    suffix="Pinned")
 )
@@ -24,32 +24,77 @@
 
 
 import os
+import stat
+import zlib
 import random
+import shutil
+import sqlite3
 import unittest
+import threading
+from tempfile import mkdtemp
+from contextlib import closing
+from collections import OrderedDict
 
 import numpy as np
-from pkg_resources import resource_filename
 
 from .. import pybgen
-from .truths import truths
+from .truths import truths, get_test_filename
 
 
 __all__ = ["reader_tests"]
 
 
+# The precision of the truths: their probabilities are rounded to 6 decimals
+# (with some room for the floating point rounding), and the dosage
+# (2 * p_bb + p_ab) adds up to three times their rounding
+_TRUTHS_TOLERANCES = {"probs": 5e-7 + 1e-12, "dosage": 1.5e-6}
+
+
 class ReaderTests(unittest.TestCase):
 
-    def setUp(self):
+    # The kind of truths of the file ("dosage" or "probs")
+    truth_kind = "dosage"
+
+    @classmethod
+    def setUpClass(cls):
         # Getting the truth for this file
-        self.truths = truths["dosage"][self.truth_filename]
+        cls.truths = truths[cls.truth_kind][cls.truth_filename]
 
-        # Reading the BGEN files
-        bgen_fn = resource_filename(__name__, self.bgen_filename)
-        self.bgen = pybgen.PyBGEN(bgen_fn)
+        # Reading the BGEN file (once for all the tests of the class)
+        cls.bgen = cls._open_bgen(get_test_filename(cls.bgen_filename))
 
-    def tearDown(self):
+    @classmethod
+    def tearDownClass(cls):
         # Closing the object
-        self.bgen.close()
+        cls.bgen.close()
+
+    @classmethod
+    def _open_bgen(cls, bgen_fn):
+        """Opens the BGEN file shared by the tests."""
+        return pybgen.PyBGEN(bgen_fn, create_indexes=False)
+
+    def setUp(self):
+        # Moving back to the first variant (the file is shared by the tests)
+        self.bgen._bgen.seek(self.bgen._first_variant_block)
+
+    def _assert_close(self, expected, observed):
+        """Checks the data is the same as the truths (up to their precision).
+
+        A single vectorized comparison is done, and the detailed (but slower)
+        numpy assertion only runs to report a difference.
+
+        """
+        atol = _TRUTHS_TOLERANCES[self.truth_kind]
+        if expected.shape == observed.shape and np.allclose(
+            expected, observed, rtol=0, atol=atol, equal_nan=True,
+        ):
+            return
+
+        np.testing.assert_allclose(observed, expected, rtol=0, atol=atol)
+
+    def _get_truth_data(self, name):
+        """Gets the data (dosage or probabilities) of a variant."""
+        return self.truths["data"][self.truths["index"][name]]
 
     def _compare_variant(self, expected, observed):
         """Compare two variants."""
@@ -59,10 +104,49 @@ class ReaderTests(unittest.TestCase):
         self.assertEqual(expected.a1, observed.a1)
         self.assertEqual(expected.a2, observed.a2)
 
+    def _compare_truth_variant(self, name, observed):
+        """Compare a variant to its information in the truths."""
+        expected = self.truths["variant_info"][self.truths["index"][name]]
+        self.assertEqual(expected["name"], observed.name)
+        self.assertEqual(expected["chrom"], observed.chrom)
+        self.assertEqual(expected["pos"], observed.pos)
+        self.assertEqual(expected["a1"], observed.a1)
+        self.assertEqual(expected["a2"], observed.a2)
+
+    def _compare_iterated_variants(self, iterator):
+        """Compares all the variants of an iterator to the truths at once.
+
+        Returns:
+            set: The names of the variants.
+
+        """
+        names = []
+        variants = []
+        data = []
+        for variant, values in iterator:
+            names.append(variant.name)
+            variants.append((variant.name, variant.chrom, variant.pos,
+                             variant.a1, variant.a2))
+            # The values might be overwritten by the next variant
+            data.append(np.array(values))
+
+        if names:
+            rows = [self.truths["index"][name] for name in names]
+            self.assertEqual(
+                self.truths["variant_info"][rows].tolist(), variants,
+            )
+            self._assert_close(self.truths["data"][rows], np.array(data))
+
+        return set(names)
+
     def test_check_returned_value(self):
         """Tests the module is returning dosage data."""
         self.assertFalse(self.bgen._return_probs)
 
+    def test_file_mapped(self):
+        """Tests the BGEN file is memory mapped."""
+        self.assertIsInstance(self.bgen._bgen, pybgen._MappedFile)
+
     def test_repr(self):
         """Tests the __repr__ representation."""
         self.assertEqual(
@@ -99,14 +183,10 @@ class ReaderTests(unittest.TestCase):
         variant, dosage = r.pop()
 
         # Checking the variant
-        self._compare_variant(
-            self.truths["variants"][name]["variant"], variant,
-        )
+        self._compare_truth_variant(name, variant)
 
         # Checking the dosage
-        np.testing.assert_array_almost_equal(
-            self.truths["variants"][name]["data"], dosage,
-        )
+        self._assert_close(self._get_truth_data(name), dosage)
 
     def test_get_middle_variant(self):
         """Tests getting a variant in the middle of the file."""
@@ -119,14 +199,10 @@ class ReaderTests(unittest.TestCase):
         variant, dosage = r.pop()
 
         # Checking the variant
-        self._compare_variant(
-            self.truths["variants"][name]["variant"], variant,
-        )
+        self._compare_truth_variant(name, variant)
 
         # Checking the dosage
-        np.testing.assert_array_almost_equal(
-            self.truths["variants"][name]["data"], dosage,
-        )
+        self._assert_close(self._get_truth_data(name), dosage)
 
     def test_get_last_variant(self):
         """Tests getting the last variant of the file."""
@@ -139,14 +215,25 @@ class ReaderTests(unittest.TestCase):
         variant, dosage = r.pop()
 
         # Checking the variant
-        self._compare_variant(
-            self.truths["variants"][name]["variant"], variant,
-        )
+        self._compare_truth_variant(name, variant)
 
         # Checking the dosage
-        np.testing.assert_array_almost_equal(
-            self.truths["variants"][name]["data"], dosage,
-        )
+        self._assert_close(self._get_truth_data(name), dosage)
+
+    def test_get_variants(self):
+        """Tests getting a list of variants."""
+        names = sorted(self.truths["variant_set"])[:5]
+        results = self.bgen.get_variants(names + ["UNKNOWN_NAME"])
+        self.assertEqual(set(names), set(results.keys()))
+
+        for name in names:
+            expected = self.bgen.get_variant(name)
+            observed = results[name]
+            self.assertEqual(len(expected), len(observed))
+            for (e_var, e_dosage), (o_var, o_dosage) in zip(expected,
+                                                            observed):
+                self._compare_variant(e_var, o_var)
+                np.testing.assert_array_equal(e_dosage, o_dosage)
 
     def test_get_missing_variant(self):
         """Tests getting a variant which is absent from the BGEN file."""
@@ -157,45 +244,38 @@ class ReaderTests(unittest.TestCase):
             str(cm.exception),
         )
 
-    def test_iter_all_variants(self):
-        """Tests the iteration of all variants."""
-        seen_variants = set()
-        for variant, dosage in self.bgen.iter_variants():
-            # The name of the variant
-            name = variant.name
-            seen_variants.add(name)
+    def test_iter_seeks_short_info_reads(self):
+        """Tests reading variants whose information is read in many steps."""
+        # The variants are read by the reader itself (the pipeline's threads
+        # and the workers have their own reader, with the default size)
+        self.bgen._bgen_index.execute(
+            "SELECT file_start_position FROM Variant",
+        )
+        seeks = self.bgen._fetch_seeks()
 
-            # Comparing the variant
-            self._compare_variant(
-                self.truths["variants"][name]["variant"],
-                variant,
+        info_size = self.bgen._variant_info_size
+        self.bgen._variant_info_size = 4
+        try:
+            seen_variants = self._compare_iterated_variants(
+                self.bgen._iter_seeks(seeks),
             )
 
-            # Comparing the dosage
-            np.testing.assert_array_almost_equal(
-                self.truths["variants"][name]["data"], dosage,
-            )
+        finally:
+            self.bgen._variant_info_size = info_size
+
+        self.assertEqual(seen_variants, self.truths["variant_set"])
+
+    def test_iter_all_variants(self):
+        """Tests the iteration of all variants."""
+        iterator = self.bgen.iter_variants()
+        seen_variants = self._compare_iterated_variants(iterator)
 
         # Checking if we checked all variants
         self.assertEqual(seen_variants, self.truths["variant_set"])
 
     def test_as_iterator(self):
         """Tests the module as iterator."""
-        seen_variants = set()
-        for variant, dosage in self.bgen:
-            # The name of the variant
-            name = variant.name
-            seen_variants.add(name)
-
-            # Comparing the variant
-            self._compare_variant(
-                self.truths["variants"][name]["variant"], variant,
-            )
-
-            # Comparing the dosage
-            np.testing.assert_array_almost_equal(
-                self.truths["variants"][name]["data"], dosage,
-            )
+        seen_variants = self._compare_iterated_variants(self.bgen)
 
         # Checking if we checked all variants
         self.assertEqual(seen_variants, self.truths["variant_set"])
@@ -209,68 +289,53 @@ class ReaderTests(unittest.TestCase):
             seen_variants.add(name)
 
             # Comparing the variant
-            self._compare_variant(
-                self.truths["variants"][name]["variant"], variant,
-            )
+            self._compare_truth_variant(name, variant)
 
         # Checking if we checked all variants
         self.assertEqual(seen_variants, self.truths["variant_set"])
 
-    def test_iter_variants_in_region(self):
-        """Tests the iteration of all variants in a genomic region."""
+    def test_iter_variant_info_arrays(self):
+        """Tests the iteration of all variants' information (as arrays)."""
         seen_variants = set()
-        iterator = self.bgen.iter_variants_in_region("01", 67000, 70999)
-        for variant, dosage in iterator:
-            # The name of the variant
-            name = variant.name
-            seen_variants.add(name)
+        for chunk in self.bgen.iter_variant_info_arrays(chunksize=64):
+            self.assertTrue(0 < len(chunk) <= 64)
+            for name, chrom, pos, a1, a2 in zip(chunk.name, chunk.chrom,
+                                                chunk.pos, chunk.a1,
+                                                chunk.a2):
+                seen_variants.add(name)
+
+                # Comparing the variant
+                self._compare_truth_variant(
+                    name, pybgen._Variant(name, chrom, pos, a1, a2),
+                )
 
-            # Comparing the variant
-            self._compare_variant(
-                self.truths["variants"][name]["variant"], variant,
-            )
+        # Checking if we checked all variants
+        self.assertEqual(seen_variants, self.truths["variant_set"])
 
-            # Comparing the dosage
-            np.testing.assert_array_almost_equal(
-                self.truths["variants"][name]["data"], dosage,
-            )
+    def test_iter_variants_in_region(self):
+        """Tests the iteration of all variants in a genomic region."""
+        iterator = self.bgen.iter_variants_in_region("01", 67000, 70999)
+        seen_variants = self._compare_iterated_variants(iterator)
 
         # Checking if we checked all variants
-        expected = set()
-        for name in self.truths["variant_set"]:
-            variant = self.truths["variants"][name]["variant"]
-            if variant.chrom == "01":
-                if variant.pos >= 67000 and variant.pos <= 70999:
-                    expected.add(name)
-        self.assertEqual(seen_variants, expected)
+        variant_info = self.truths["variant_info"]
+        in_region = (
+            (variant_info["chrom"] == "01") &
+            (variant_info["pos"] >= 67000) & (variant_info["pos"] <= 70999)
+        )
+        self.assertEqual(seen_variants, set(variant_info["name"][in_region]))
 
     def test_get_specific_variant(self):
         """Test for specific variant lookup."""
-        seen_variants = set()
         iterator = self.bgen.get_specific_variant("01", 67000, "A", "G")
-        for variant, dosage in iterator:
-            # The name of the variant
-            name = variant.name
-            seen_variants.add(name)
-
-            # Comparing the variant
-            self._compare_variant(
-                self.truths["variants"][name]["variant"], variant,
-            )
-
-            # Comparing the dosage
-            np.testing.assert_array_almost_equal(
-                self.truths["variants"][name]["data"], dosage,
-            )
+        seen_variants = self._compare_iterated_variants(iterator)
 
         # Checking if we checked all variants
-        expected = set()
-        for name in self.truths["variant_set"]:
-            variant = self.truths["variants"][name]["variant"]
-            if variant.chrom == "01":
-                if variant.pos == 67000:
-                    expected.add(name)
-        self.assertEqual(seen_variants, expected)
+        variant_info = self.truths["variant_info"]
+        at_position = (
+            (variant_info["chrom"] == "01") & (variant_info["pos"] == 67000)
+        )
+        self.assertEqual(seen_variants, set(variant_info["name"][at_position]))
 
     def test_get_missing_specific_variant(self):
         """Tests getting a specific variant which is absent from the file."""
@@ -284,27 +349,15 @@ class ReaderTests(unittest.TestCase):
     def test_iter_seeks(self):
         """Tests the _iter_seeks function."""
         # Fetching random seeks from the index
+        # (sampled by SQLite, so that only the sampled rows are fetched)
         self.bgen._bgen_index.execute(
-            "SELECT rsid, file_start_position FROM Variant"
+            "SELECT rsid, file_start_position FROM Variant "
+            "ORDER BY RANDOM() LIMIT 5"
         )
-        seeks = random.sample(self.bgen._bgen_index.fetchall(), 5)
+        seeks = self.bgen._bgen_index.fetchall()
 
-        seen_variants = set()
         iterator = self.bgen._iter_seeks([_[1] for _ in seeks])
-        for variant, dosage in iterator:
-            # The name of the variant
-            name = variant.name
-            seen_variants.add(name)
-
-            # Comparing the variant
-            self._compare_variant(
-                self.truths["variants"][name]["variant"], variant,
-            )
-
-            # Comparing the dosage
-            np.testing.assert_array_almost_equal(
-                self.truths["variants"][name]["data"], dosage,
-            )
+        seen_variants = self._compare_iterated_variants(iterator)
 
         # Checking if we checked all variants
         self.assertEqual(seen_variants, {_[0] for _ in seeks})
@@ -312,133 +365,385 @@ class ReaderTests(unittest.TestCase):
     def test_iter_variants_by_name(self):
         """Tests the iteration of variants by name."""
         # Fetching random variants in the index
-        self.bgen._bgen_index.execute("SELECT rsid FROM Variant")
-        names = [
-            _[0] for _ in random.sample(self.bgen._bgen_index.fetchall(), 5)
-        ]
+        # (sampled by SQLite, so that only the sampled rows are fetched)
+        self.bgen._bgen_index.execute(
+            "SELECT rsid FROM Variant ORDER BY RANDOM() LIMIT 5"
+        )
+        names = [_[0] for _ in self.bgen._bgen_index.fetchall()]
 
-        seen_variants = set()
         iterator = self.bgen.iter_variants_by_names(names)
-        for variant, dosage in iterator:
-            # The name of the variant
-            name = variant.name
-            seen_variants.add(name)
-
-            # Comparing the variant
-            self._compare_variant(
-                self.truths["variants"][name]["variant"],
-                variant,
-            )
-
-            # Comparing the dosage
-            np.testing.assert_array_almost_equal(
-                self.truths["variants"][name]["data"], dosage,
-            )
+        seen_variants = self._compare_iterated_variants(iterator)
 
         # Checking if we checked all variants
         self.assertEqual(seen_variants, set(names))
 
+    def test_get_seeks_for_names_sorted(self):
+        """Tests the seeks for names are sorted by file position."""
+        self.bgen._bgen_index.execute("SELECT rsid FROM Variant")
+        names = [_[0] for _ in self.bgen._bgen_index.fetchall()]
+        random.shuffle(names)
+
+        seeks = self.bgen._get_seeks_for_names(names)
+        self.assertEqual(len(names), len(seeks))
+        self.assertEqual(sorted(seeks), list(seeks))
+
+    def test_iter_variants_by_many_names(self):
+        """Tests the iteration of variants using a large list of names."""
+        # All the variants, with a lot of unknown names
+        names = list(self.truths["variant_set"])
+        names.extend("UNKNOWN_{}".format(i) for i in range(1000))
+
+        # Doing it twice (the temporary table is reused)
+        for _ in range(2):
+            seen_variants = set()
+            for variant, _ in self.bgen.iter_variants_by_names(names):
+                seen_variants.add(variant.name)
+            self.assertEqual(seen_variants, self.truths["variant_set"])
+
 
 class ProbsReaderTests(ReaderTests):
 
-    def setUp(self):
-        # Getting the truth for this file
-        self.truths = truths["probs"][self.truth_filename]
+    truth_kind = "probs"
 
-        # Reading the BGEN files
-        bgen_fn = resource_filename(__name__, self.bgen_filename)
-        self.bgen = pybgen.PyBGEN(bgen_fn, probs_only=True)
+    @classmethod
+    def _open_bgen(cls, bgen_fn):
+        """Opens the BGEN file shared by the tests."""
+        return pybgen.PyBGEN(bgen_fn, probs_only=True, create_indexes=False)
 
     def test_check_returned_value(self):
         """Tests the module is returning probability data."""
         self.assertTrue(self.bgen._return_probs)
 
 
-class Test32bits(ReaderTests):
-    bgen_filename = os.path.join("data", "example.32bits.bgen")
-    truth_filename = "example.32bits.truths.txt.bz2"
+class PrefetchReaderTests(ReaderTests):
 
+    @classmethod
+    def _open_bgen(cls, bgen_fn):
+        """Opens the BGEN file shared by the tests."""
+        return pybgen.PyBGEN(bgen_fn, prefetch=4, create_indexes=False)
 
-class Test32bitsProbs(ProbsReaderTests):
-    bgen_filename = os.path.join("data", "example.32bits.bgen")
-    truth_filename = "example.32bits.probs.truths.txt.bz2"
+    def test_early_stop(self):
+        """Tests stopping the iteration before the end."""
+        prefix = "pybgen-{:x}-".format(id(self.bgen))
 
+        iterator = self.bgen.iter_variants()
+        for _ in zip(range(5), iterator):
+            pass
+        threads = [thread for thread in threading.enumerate()
+                   if thread.name.startswith(prefix)]
+        self.assertEqual(2, len(threads))
+        iterator.close()
 
-class Test24bits(ReaderTests):
-    bgen_filename = os.path.join("data", "example.24bits.bgen")
-    truth_filename = "example.24bits.truths.txt.bz2"
+        # The pipeline's threads should have been stopped (the other threads
+        # might be from tests running concurrently)
+        for thread in threads:
+            self.assertFalse(thread.is_alive())
 
 
-class Test24bitsProbs(ProbsReaderTests):
-    bgen_filename = os.path.join("data", "example.24bits.bgen")
-    truth_filename = "example.24bits.probs.truths.txt.bz2"
+class PrefetchProbsReaderTests(PrefetchReaderTests):
 
+    truth_kind = "probs"
 
-class Test16bits(ReaderTests):
-    bgen_filename = os.path.join("data", "example.16bits.bgen")
-    truth_filename = "example.16bits.truths.txt.bz2"
+    @classmethod
+    def _open_bgen(cls, bgen_fn):
+        """Opens the BGEN file shared by the tests."""
+        return pybgen.PyBGEN(bgen_fn, probs_only=True, prefetch=4,
+                             create_indexes=False)
 
+    def test_check_returned_value(self):
+        """Tests the module is returning probability data."""
+        self.assertTrue(self.bgen._return_probs)
 
-class Test16bitsProbs(ProbsReaderTests):
-    bgen_filename = os.path.join("data", "example.16bits.bgen")
-    truth_filename = "example.16bits.probs.truths.txt.bz2"
 
+class TestSQLIndexes(unittest.TestCase):
 
-@unittest.skipIf(not pybgen.HAS_ZSTD, "module 'zstandard' not installed")
-class Test16bitsZstd(ReaderTests):
-    bgen_filename = os.path.join("data", "example.16bits.zstd.bgen")
-    truth_filename = "example.16bits.zstd.truths.txt.bz2"
+    def setUp(self):
+        # Copying the BGEN file (and its index) in a temporary directory
+        self.tmp_dir = mkdtemp(prefix="pybgen_test_")
+        self.bgen_fn = os.path.join(self.tmp_dir, "example.bgen")
+        original_fn = get_test_filename(
+            os.path.join("data", "example.16bits.bgen"),
+        )
+        shutil.copyfile(original_fn, self.bgen_fn)
+        shutil.copyfile(original_fn + ".bgi", self.bgen_fn + ".bgi")
 
+        self.truths = truths["dosage"]["example.16bits.truths.txt.bz2"]
 
-@unittest.skipIf(not pybgen.HAS_ZSTD, "module 'zstandard' not installed")
-class Test16bitsZstdProbs(ProbsReaderTests):
-    bgen_filename = os.path.join("data", "example.16bits.zstd.bgen")
-    truth_filename = "example.16bits.zstd.probs.truths.txt.bz2"
+    def tearDown(self):
+        # The index might have been made read only
+        os.chmod(self.bgen_fn + ".bgi", stat.S_IRUSR | stat.S_IWUSR)
+        shutil.rmtree(self.tmp_dir)
+
+    def _get_sql_indexes(self):
+        """Gets the names of the index file's SQL indexes."""
+        with closing(sqlite3.connect(self.bgen_fn + ".bgi")) as db:
+            rows = db.execute("PRAGMA index_list(Variant)").fetchall()
+        return {row[1] for row in rows}
+
+    def _check_lookups(self, bgen):
+        """Checks the name and region lookups of a BGEN file."""
+        names = sorted(self.truths["variant_set"])[:10]
+        self.assertEqual(
+            set(names),
+            {variant.name
+             for variant, _ in bgen.iter_variants_by_names(names)},
+        )
 
+        variant_info = self.truths["variant_info"]
+        chrom = variant_info["chrom"][0]
+        in_region = variant_info[(variant_info["chrom"] == chrom) &
+                                 (variant_info["pos"] <= 5000)]
+        self.assertEqual(
+            set(in_region["name"]),
+            {variant.name
+             for variant, _ in bgen.iter_variants_in_region(chrom, 0, 5000)},
+        )
 
-class Test9bits(ReaderTests):
-    bgen_filename = os.path.join("data", "example.9bits.bgen")
-    truth_filename = "example.9bits.truths.txt.bz2"
+    def test_indexes_created(self):
+        """Tests the missing indexes are created in the index file."""
+        # The primary key of the index file already starts with the
+        # chromosome and the position, so only the names are indexed
+        self.assertNotIn("pybgen_rsid", self._get_sql_indexes())
 
+        with pybgen.PyBGEN(self.bgen_fn) as bgen:
+            self._check_lookups(bgen)
 
-class Test9bitsProbs(ProbsReaderTests):
-    bgen_filename = os.path.join("data", "example.9bits.bgen")
-    truth_filename = "example.9bits.probs.truths.txt.bz2"
+            # The name and region lookups use a covering index
+            for statement in ("SELECT file_start_position FROM Variant "
+                              "WHERE rsid = ?",
+                              "SELECT file_start_position FROM Variant "
+                              "WHERE chromosome = ? AND position >= ? AND "
+                              "      position <= ?"):
+                bgen._bgen_index.execute(
+                    "EXPLAIN QUERY PLAN " + statement,
+                    (None, ) * statement.count("?"),
+                )
+                plan = " ".join(row[-1] for row in bgen._bgen_index)
+                self.assertIn("COVERING INDEX", plan)
 
+        indexes = self._get_sql_indexes()
+        self.assertIn("pybgen_rsid", indexes)
+        self.assertNotIn("pybgen_region", indexes)
 
-class Test8bits(ReaderTests):
-    bgen_filename = os.path.join("data", "example.8bits.bgen")
-    truth_filename = "example.8bits.truths.txt.bz2"
+        # The indexes are only created once
+        with pybgen.PyBGEN(self.bgen_fn):
+            pass
+        self.assertEqual(indexes, self._get_sql_indexes())
 
+    def test_indexes_not_created(self):
+        """Tests the index file isn't modified when not creating indexes."""
+        indexes = self._get_sql_indexes()
 
-class Test8bitsProbs(ProbsReaderTests):
-    bgen_filename = os.path.join("data", "example.8bits.bgen")
-    truth_filename = "example.8bits.probs.truths.txt.bz2"
+        with pybgen.PyBGEN(self.bgen_fn, create_indexes=False) as bgen:
+            self._check_lookups(bgen)
 
+        self.assertEqual(indexes, self._get_sql_indexes())
 
-class Test3bits(ReaderTests):
-    bgen_filename = os.path.join("data", "example.3bits.bgen")
-    truth_filename = "example.3bits.truths.txt.bz2"
+    @unittest.skipIf(hasattr(os, "geteuid") and os.geteuid() == 0,
+                     "the index is always writable by root")
+    def test_read_only_index(self):
+        """Tests the lookups still work when the index file is read only."""
+        indexes = self._get_sql_indexes()
+        os.chmod(self.bgen_fn + ".bgi", stat.S_IRUSR)
 
+        with self.assertLogs(pybgen.logger, "INFO") as logs:
+            bgen = pybgen.PyBGEN(self.bgen_fn)
+        self.assertIn("unable to create index 'pybgen_rsid'", logs.output[0])
 
-class Test3bitsProbs(ProbsReaderTests):
-    bgen_filename = os.path.join("data", "example.3bits.bgen")
-    truth_filename = "example.3bits.probs.truths.txt.bz2"
+        with bgen:
+            self._check_lookups(bgen)
 
+        self.assertEqual(indexes, self._get_sql_indexes())
 
-class TestLayout1(ReaderTests):
-    bgen_filename = os.path.join("data", "cohort1.bgen")
-    truth_filename = "cohort1.truths.txt.bz2"
 
+class TestDecompression(unittest.TestCase):
 
-class TestLayout1Probs(ProbsReaderTests):
-    bgen_filename = os.path.join("data", "cohort1.bgen")
-    truth_filename = "cohort1.probs.truths.txt.bz2"
+    def setUp(self):
+        self.data = np.random.randint(0, 4, size=10000).astype(np.uint8)
+        self.data = self.data.tobytes()
+
+    def test_zlib_decompress(self):
+        """Tests the zlib decompression."""
+        compressed = zlib.compress(self.data)
+        self.assertEqual(
+            self.data,
+            pybgen.PyBGEN._zlib_decompress(compressed, len(self.data)),
+        )
+
+    @unittest.skipIf(not pybgen.HAS_ISAL, "module 'isal' not installed")
+    def test_isal_decompress(self):
+        """Tests the zlib decompression using ISA-L."""
+        compressed = zlib.compress(self.data)
+        self.assertEqual(
+            self.data,
+            pybgen.PyBGEN._isal_decompress(compressed, len(self.data)),
+        )
+
+    @unittest.skipIf(not pybgen.HAS_ZSTD, "module 'zstandard' not installed")
+    def test_zstd_decompress_without_content_size(self):
+        """Tests the zstandard decompression without the content size."""
+        compressor = pybgen.zstd.ZstdCompressor(write_content_size=False)
+        compressed = compressor.compress(self.data)
+
+        bgen = pybgen.PyBGEN.__new__(pybgen.PyBGEN)
+        bgen._zstd_decompressor = pybgen.zstd.ZstdDecompressor()
+        self.assertEqual(
+            self.data, bgen._zstd_decompress(compressed, len(self.data)),
+        )
+
+
+def _iter_random_layout_2_probs():
+    """Generates random raw probabilities (layout 2) and their dosage.
+
+    Yields the number of bits, the raw probabilities, the missing samples and
+    the expected dosage (computed in double precision, with a probability
+    threshold of 0.9), for some numbers of bits.
+
+    """
+    for b, dtype in ((3, np.uint64), (8, np.uint8), (16, np.uint16),
+                     (32, np.uint32)):
+        # Generating random probabilities (the sum is at most 1)
+        max_value = 2**b - 1
+        raw = np.random.randint(0, max_value + 1, size=(1000, 2))
+        raw[:, 1] = np.minimum(raw[:, 1], max_value - raw[:, 0])
+        raw = raw.astype(dtype)
+
+        # The expected dosage
+        probs = raw / max_value
+        last_probs = 1 - np.sum(probs, axis=1)
+        expected = 2 * last_probs + probs[:, 1]
+        good_probs = (
+            np.any(probs >= 0.9, axis=1) | (last_probs >= 0.9)
+        )
+        expected[~good_probs] = np.nan
+
+        # Some missing samples
+        missing_data = np.random.random_sample(1000) < 0.1
+        expected[missing_data] = np.nan
+
+        yield b, raw.ravel(), missing_data, expected
+
+
+class TestNumpyDosage(unittest.TestCase):
+
+    def test_layout_2_dosage(self):
+        """Tests the numpy dosage is the same as the kernels' dosage."""
+        bgen = pybgen.PyBGEN.__new__(pybgen.PyBGEN)
+        bgen.prob_t = 0.9
+
+        for b, raw, missing_data, expected in _iter_random_layout_2_probs():
+            observed = bgen._layout_2_raw_probs_to_dosage(raw, b)
+            observed[missing_data] = np.nan
+            self.assertEqual(np.float64, observed.dtype)
+            np.testing.assert_array_equal(expected, observed)
+
+
+class KernelsTests:
+
+    def test_layout_2_dosage(self):
+        """Tests the kernel's dosage is the same as the numpy dosage."""
+        layout_2_dosage = self.kernels.layout_2_dosage
+
+        for b, raw, missing_data, expected in _iter_random_layout_2_probs():
+            observed = np.empty(1000)
+            layout_2_dosage(raw, float(2**b - 1), 0.9, missing_data,
+                            observed)
+            np.testing.assert_array_equal(expected, observed)
+
+    def test_unpack_bits(self):
+        """Tests the kernel's unpacking is the same as the numpy unpacking."""
+        unpack_bits = self.kernels.unpack_bits
+
+        for b in range(1, 33):
+            # Generating random bytes (for 104 values, a multiple of 8)
+            data = np.random.randint(0, 256, size=13 * b).astype(np.uint8)
+
+            expected = pybgen._pack_bits(data.tobytes(), b)
+
+            observed = np.empty(104, dtype=np.uint32)
+            unpack_bits(data, b, observed)
+            np.testing.assert_array_equal(expected, observed)
+
+
+@unittest.skipIf(not pybgen.HAS_NUMBA, "module 'numba' not installed")
+class TestNumbaKernels(KernelsTests, unittest.TestCase):
+
+    def setUp(self):
+        from .. import _numba_kernels
+        self.kernels = _numba_kernels
+
+
+class TestCythonKernels(KernelsTests, unittest.TestCase):
+
+    def setUp(self):
+        try:
+            from .. import _decode
+        except ImportError:
+            self.skipTest("Cython kernels not built")
+        self.kernels = _decode
+
+
+# The example BGEN files (the name of their test cases, and the prefix of
+# their file names)
+_EXAMPLES = OrderedDict([
+    ("32bits", "example.32bits"),
+    ("24bits", "example.24bits"),
+    ("16bits", "example.16bits"),
+    ("16bitsZstd", "example.16bits.zstd"),
+    ("9bits", "example.9bits"),
+    ("8bits", "example.8bits"),
+    ("3bits", "example.3bits"),
+    ("Layout1", "cohort1"),
+])
+
+
+def make_test_cases(namespace, base, examples=None, suffix=""):
+    """Makes the test cases of example BGEN files.
+
+    Args:
+        namespace (dict): The namespace where the test cases are added.
+        base (type): The test case they are derived from (its ``truth_kind``
+                     selects the truths).
+        examples (iterable): The examples (all of them by default).
+        suffix (str): The suffix of the name of the test cases.
+
+    Returns:
+        tuple: The test cases (``Test<example><suffix>``).
+
+    """
+    if examples is None:
+        examples = _EXAMPLES.keys()
+
+    test_cases = []
+    for example in examples:
+        prefix = _EXAMPLES[example]
+        truth_prefix = prefix
+        if base.truth_kind == "probs":
+            truth_prefix += ".probs"
+
+        test_case = type("Test" + example + suffix, (base, ), {
+            "__module__": namespace["__name__"],
+            "bgen_filename": os.path.join("data", prefix + ".bgen"),
+            "truth_filename": truth_prefix + ".truths.txt.bz2",
+        })
+        if prefix.endswith(".zstd"):
+            test_case = unittest.skipIf(
+                not pybgen.HAS_ZSTD, "module 'zstandard' not installed",
+            )(test_case)
+
+        namespace[test_case.__name__] = test_case
+        test_cases.append(test_case)
+
+    return tuple(test_cases)
 
 
 reader_tests = (
-    Test32bits, Test24bits, Test16bits, Test16bitsZstd, Test9bits, Test8bits,
-    Test3bits, TestLayout1, Test32bitsProbs, Test24bitsProbs, Test16bitsProbs,
-    Test16bitsZstdProbs, Test9bitsProbs, Test8bitsProbs, Test3bitsProbs,
-    TestLayout1Probs,
+    make_test_cases(globals(), ReaderTests) +
+    make_test_cases(globals(), ProbsReaderTests, suffix="Probs") +
+    (TestSQLIndexes, TestDecompression, TestNumpyDosage, TestNumbaKernels,
+     TestCythonKernels) +
+    make_test_cases(globals(), PrefetchReaderTests, ("16bits", "Layout1"),
+                    suffix="Prefetch") +
+    make_test_cases(globals(), PrefetchProbsReaderTests, ("16bits", ),
+                    suffix="PrefetchProbs")
 )
@@ -25,12 +25,13 @@
 
 import os
 import bz2
-import itertools
+import pickle
+import threading
+from sys import intern
+from tempfile import mkstemp
+from multiprocessing import Pool
 
 import numpy as np
-from pkg_resources import resource_filename
-
-from ..pybgen import _Variant as Variant
 
 
 __author__ = "Louis-Philippe Lemieux Perreault"
@@ -38,8 +39,12 @@ __copyright__ = "Copyright 2014 Louis-Philippe Lemieux Perreault"
 __license__ = "MIT"
 
 
-__all__ = ["truths"]
+__all__ = ["truths", "read_all_truths", "get_test_filename"]
+
 
+# The directory of the tests (the package isn't zip safe, so the test files
+# are always on the disk)
+_TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
 
 # The name of the files containing the dosage truths
 _DOSAGE_FILENAMES = (
@@ -66,59 +71,179 @@ _PROBS_FILENAMES = (
 )
 
 
-def _generate_truths():
-    """Generate the truths."""
-    final_dosage_truths = {}
-    final_probs_truths = {}
-
-    #  Generating the truths for the dosage files
-    for filename in itertools.chain(_DOSAGE_FILENAMES, _PROBS_FILENAMES):
-        is_probs = filename.endswith("probs.truths.txt.bz2")
-
-        fn = resource_filename(__name__, filename)
-        file_truths = {}
-        with bz2.BZ2File(fn, "r") as f:
-            # Reading the data
-            data = tuple(
-                row.strip().split("\t")
-                for row in f.read().decode().splitlines()
+# The type of the data (dosage or probabilities) returned by the reader
+_DATA_DTYPE = np.float64
+
+# The fields of the variants' information
+_VARIANT_INFO_DTYPE = [
+    ("name", object), ("chrom", object), ("pos", np.int64), ("a1", object),
+    ("a2", object),
+]
+
+# The version of the truths' structure (the cached truths of another
+# version are read again)
+_CACHE_VERSION = 3
+
+
+def get_test_filename(filename):
+    """Gets the path of a test file (relative to the tests' package)."""
+    return os.path.join(_TESTS_DIR, filename)
+
+
+def _read_truths(filename):
+    """Reads the truths of a file.
+
+    The truths are stored by column: the variants' information is in a
+    structured array, and their values in a single array (one row per
+    variant, in the same order). The row of a variant is found using its
+    name in the ``index``.
+
+    """
+    is_probs = filename.endswith("probs.truths.txt.bz2")
+
+    fn = get_test_filename(filename)
+    file_truths = {}
+    with bz2.BZ2File(fn, "r") as f:
+        # The first row contains the samples
+        header = next(f).decode().strip().split("\t")
+        samples = tuple(header)
+        nb_samples = len(samples)
+        if samples[0] == "None":
+            samples = None
+            nb_samples = int(header[1])
+        file_truths["samples"] = samples
+        file_truths["nb_samples"] = nb_samples
+
+        # The other rows are read one at a time. Their first five columns
+        # contain the variant, and the remaining ones its values (kept
+        # together, to be parsed by numpy in one call)
+        variants = []
+        data = []
+        for row in f:
+            name, chrom, pos, a1, a2, values = row.decode().strip().split(
+                "\t", 5,
             )
-
-            # The first row contains the samples
-            samples = tuple(data[0])
-            nb_samples = len(samples)
-            if samples[0] == "None":
-                samples = None
-                nb_samples = int(data[0][1])
-            file_truths["samples"] = samples
-            file_truths["nb_samples"] = nb_samples
-
-            # The first column of each row contains the markers
-            markers = tuple(row[0] for row in data[1:])
-            file_truths["variant_set"] = set(markers)
-            file_truths["nb_variants"] = len(markers)
-
-            # Now, constructing the variants
-            file_truths["variants"] = {}
-            for variant_data in data[1:]:
-                name, chrom, pos, a1, a2 = variant_data[:5]
-                variant = Variant(name, chrom, int(pos), a1, a2)
-                values = np.array(variant_data[5:], dtype=float)
-                if is_probs:
-                    values.shape = (nb_samples, 3)
-                file_truths["variants"][name] = {
-                    "variant": variant,
-                    "data": values,
-                }
-
-        # Saving the file truths
-        if is_probs:
-            final_probs_truths[os.path.basename(fn)] = file_truths
-        else:
-            final_dosage_truths[os.path.basename(fn)] = file_truths
-
-    return {"dosage": final_dosage_truths, "probs": final_probs_truths}
+            # The chromosomes and alleles are shared by many variants
+            variants.append(
+                (name, intern(chrom), int(pos), intern(a1), intern(a2)),
+            )
+            data.append(np.fromstring(values, dtype=_DATA_DTYPE, sep="\t"))
+
+    variant_info = np.array(variants, dtype=_VARIANT_INFO_DTYPE)
+    file_truths["variant_info"] = variant_info
+    file_truths["index"] = {
+        name: i for i, name in enumerate(variant_info["name"])
+    }
+    # The set of names is immutable, since it's shared by the test cases
+    file_truths["variant_set"] = frozenset(file_truths["index"])
+    file_truths["nb_variants"] = len(variant_info)
+
+    # The values have the same type and (C contiguous) layout as the ones
+    # returned by the reader, so that comparing them doesn't need any
+    # conversion
+    data = np.array(data, dtype=_DATA_DTYPE)
+    if is_probs:
+        data = data.reshape(len(variant_info), nb_samples, 3)
+    file_truths["data"] = data
+
+    return file_truths
+
+
+def _read_cached_truths(filename):
+    """Reads the truths of a file (from its cache, if it's up to date).
+
+    The parsed truths are saved in a ``.cache.pkl`` file next to the truth
+    file, along with the modification time and size of the truth file (so
+    that a modified truth file is read again) and the version of the truths'
+    structure.
+
+    """
+    fn = get_test_filename(filename)
+    cache_fn = fn + ".cache.pkl"
+    source = (_CACHE_VERSION, os.path.getmtime(fn), os.path.getsize(fn))
+
+    # The truths might have been saved from a previous run
+    try:
+        with open(cache_fn, "rb") as f:
+            cached_source, file_truths = pickle.load(f)
+        if cached_source == source:
+            return file_truths
+    except (IOError, OSError, EOFError, ValueError, pickle.UnpicklingError):
+        pass
+
+    file_truths = _read_truths(filename)
+
+    # Saving the truths (the file is renamed once it is complete)
+    tmp_fn = None
+    try:
+        fd, tmp_fn = mkstemp(suffix=".tmp", dir=os.path.dirname(fn))
+        with os.fdopen(fd, "wb") as f:
+            pickle.dump((source, file_truths), f, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp_fn, cache_fn)
+    except (IOError, OSError):
+        if tmp_fn is not None and os.path.isfile(tmp_fn):
+            os.remove(tmp_fn)
+
+    return file_truths
+
+
+class _Truths(dict):
+    """The truths of files (by name), read once on their first access.
+
+    The test cases might run concurrently (in threads), so a file is read
+    while holding a lock (another test case needing it waits instead of
+    reading it a second time).
+
+    """
+
+    def __init__(self, filenames):
+        super().__init__()
+        self._filenames = {os.path.basename(fn): fn for fn in filenames}
+        self._lock = threading.Lock()
+
+    def __missing__(self, name):
+        with self._lock:
+            # The file might have been read while waiting for the lock
+            if name in self:
+                return dict.__getitem__(self, name)
+
+            file_truths = self[name] = _read_cached_truths(
+                self._filenames[name],
+            )
+            return file_truths
 
 
 # All the truths
-truths = _generate_truths()
+truths = {
+    "dosage": _Truths(_DOSAGE_FILENAMES),
+    "probs": _Truths(_PROBS_FILENAMES),
+}
+
+
+def read_all_truths(jobs=1):
+    """Reads the truths of all the files which weren't read yet.
+
+    Args:
+        jobs (int): The number of files to read at the same time (each one
+                    in its own process).
+
+    """
+    missing = [
+        (kind_truths, name) for kind_truths in truths.values()
+        for name in sorted(kind_truths._filenames) if name not in kind_truths
+    ]
+    if not missing:
+        return
+
+    pool = Pool(max(1, min(jobs, len(missing))))
+    try:
+        missing_truths = pool.map(
+            _read_cached_truths,
+            [kind_truths._filenames[name] for kind_truths, name in missing],
+        )
+    finally:
+        pool.close()
+        pool.join()
+
+    for (kind_truths, name), file_truths in zip(missing, missing_truths):
+        kind_truths[name] = file_truths
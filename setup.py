@@ -2,7 +2,9 @@
 
 # How to build source distribution
 #   - python setup.py sdist --format gztar
-#   - python setup.py bdist_wheel --universal
+#   - python setup.py bdist_wheel (the wheels are specific to the Python
+#     version and platform, since they contain the compiled Cython kernels;
+#     they are built by the wheels workflow using cibuildwheel)
 
 # How to build for conda
 #   - mkdir -p ./conda_skeleton && cd ./conda_skeleton
@@ -15,7 +17,8 @@
 
 
 import os
-from setuptools import setup
+import sys
+from setuptools import setup, Extension
 
 
 MAJOR = 0
@@ -34,22 +37,80 @@ def write_version_file(fn=None):
     content = (
         "\n# THIS FILE WAS GENERATED AUTOMATICALLY BY PYBGEN SETUP.PY\n"
         'pybgen_version = "{version}"\n'
-    )
+    ).format(version=VERSION)
+
+    # The file is only written if its content changes (so that its
+    # modification time doesn't trigger rebuilds)
+    if os.path.isfile(fn):
+        with open(fn, "r") as f:
+            if f.read() == content:
+                return
 
     a = open(fn, "w")
     try:
-        a.write(content.format(version=VERSION))
+        a.write(content)
     finally:
         a.close()
 
 
 def get_requirements():
     # Initial requirements
-    requirements = ["numpy >= 1.12.0", "six >= 1.10.0", "setuptools >= 27.0"]
+    requirements = ["numpy >= 1.17.3"]
 
     return requirements
 
 
+# The compiler flags of the Cython kernels for each build mode (the profile
+# mode keeps the release optimizations, with what's needed to sample the
+# call stacks)
+BUILD_MODES = {
+    "release": ["-O3", "-funroll-loops"],
+    "debug": ["-O0", "-g"],
+    "profile": ["-O3", "-funroll-loops", "-g", "-fno-omit-frame-pointer"],
+}
+
+
+def get_extensions():
+    # The Cython kernels are optional (numba is used instead, if installed)
+    try:
+        from Cython.Build import cythonize
+    except ImportError:
+        return []
+
+    build_mode = os.environ.get("PYBGEN_BUILD_MODE", "release")
+    if build_mode not in BUILD_MODES:
+        raise ValueError("{}: invalid PYBGEN_BUILD_MODE (choose from {})"
+                         "".format(build_mode, ", ".join(BUILD_MODES)))
+
+    extra_compile_args = []
+    if sys.platform != "win32":
+        extra_compile_args.extend(BUILD_MODES[build_mode])
+
+        # Tuning for the CPU of the build machine is only done on request
+        # (the extension might not run on another CPU)
+        if os.environ.get("PYBGEN_MARCH_NATIVE", "0") == "1":
+            extra_compile_args.append("-march=native")
+
+    extensions = cythonize(
+        [
+            Extension(
+                "pybgen._decode", [os.path.join("pybgen", "_decode.pyx")],
+                extra_compile_args=extra_compile_args,
+            ),
+        ],
+        language_level=3,
+    )
+
+    # The extensions are optional (a failed build only gives a warning),
+    # since Cython is always installed when building with pip, but a
+    # compiler might not be available (this is set after cythonize, which
+    # doesn't keep the attribute)
+    for extension in extensions:
+        extension.optional = True
+
+    return extensions
+
+
 def setup_package():
     # Saving the version into a file
     write_version_file()
@@ -64,18 +125,24 @@ def setup_package():
         url="https://github.com/lemieuxl/pybgen",
         license="MIT",
         packages=["pybgen", "pybgen.tests"],
-        package_data={"pybgen.tests": ["data/*"], },
+        ext_modules=get_extensions(),
+        package_data={
+            # Only the test files (not the caches saved when testing)
+            "pybgen.tests": ["data/*.bgen", "data/*.bgi", "data/*.bz2",
+                             "data/*.mkd"],
+        },
         test_suite="pybgen.tests.test_suite",
         install_requires=get_requirements(),
+        python_requires=">=3.8",
         classifiers=["Operating System :: POSIX :: Linux",
                      "Operating System :: MacOS :: MacOS X",
                      "Operating System :: Microsoft",
                      "Programming Language :: Python",
-                     "Programming Language :: Python :: 2.7",
                      "Programming Language :: Python :: 3",
-                     "Programming Language :: Python :: 3.6",
-                     "Programming Language :: Python :: 3.7",
+                     "Programming Language :: Python :: 3 :: Only",
                      "Programming Language :: Python :: 3.8",
+                     "Programming Language :: Python :: 3.9",
+                     "Programming Language :: Python :: 3.10",
                      "License :: OSI Approved :: MIT License",
                      "Topic :: Scientific/Engineering :: Bio-Informatics"],
         keywords="bioinformatics format BGEN binary",